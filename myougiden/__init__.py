@@ -31,3 +31,6 @@ def find_config():
     return None
 
 config = find_config()
+
+# library interface; imported last, since its modules need config.
+from myougiden.dictionary import Dictionary
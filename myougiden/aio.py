@@ -0,0 +1,159 @@
+'''asyncio interface to myougiden.
+
+    >>> from myougiden.aio import AsyncDictionary
+    >>> d = AsyncDictionary(limit=5)
+    >>> entries = await d.lookup('chanoyu')
+
+SQLite calls run in a pool of worker threads, each with its own read-only
+connections (see dictionary.Dictionary), so the event loop is never
+blocked.
+
+Searches that scan whole tables (regexps and partial matches; see
+SearchConditions.is_scan()) are slow.  At most max_scans of them run at
+once, so that the other workers stay free for cheap, indexed lookups.
+Scans the planner expects to be small (see planner.cost()) don't count.
+
+Cancelling a lookup (e.g. with Task.cancel()) also aborts its running
+SQLite statement.  For autocomplete and the like, pass the same key= to
+successive lookups; starting a lookup cancels the previous one with the
+same key.
+'''
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from myougiden import composite
+from myougiden import database
+from myougiden import planner
+from myougiden import search
+from myougiden.dictionary import Dictionary
+
+
+class AsyncDictionary():
+    '''Like dictionary.Dictionary, but lookups are coroutines.
+
+    max_workers -- number of worker threads (and connections).
+    max_scans -- how many of them may be running table scans at once.
+
+    Other keyword arguments are default options for lookup().'''
+
+    def __init__(self, max_workers=4, max_scans=1, **defaults):
+        if not 0 < max_scans < max_workers:
+            raise ValueError('max_scans must be between 1 and max_workers - 1')
+
+        self.dictionary = Dictionary(**defaults)
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.max_scans = max_scans
+
+        # created on first use, inside the event loop
+        self.scan_semaphore = None
+
+        # key -> Task, for superseding lookups
+        self.running = {}
+
+    def close(self):
+        '''Stop worker threads (their connections are closed with them).'''
+
+        self.executor.shutdown()
+
+    async def run(self, scan, budget, case_sensitive, function, *args):
+        '''Run function(cur, *args) in a worker thread, under budget (see
+        database.Budget).
+
+        If scan is True, wait for a free scan slot first.'''
+
+        loop = asyncio.get_running_loop()
+        if scan:
+            if self.scan_semaphore is None:
+                self.scan_semaphore = asyncio.Semaphore(self.max_scans)
+            async with self.scan_semaphore:
+                return await loop.run_in_executor(
+                    self.executor, self.dictionary.run_cancellable,
+                    budget, case_sensitive, function, *args)
+        else:
+            return await loop.run_in_executor(
+                self.executor, self.dictionary.run_cancellable,
+                budget, case_sensitive, function, *args)
+
+    async def lookup(self, query, key=None, **options):
+        '''Return list of Entry objects matching query, best first.
+
+        Options are as in Dictionary.lookup().  If key is given, any
+        unfinished lookup with the same key is cancelled (it raises
+        asyncio.CancelledError in its caller).'''
+
+        # the lookup runs in a task of its own, so that superseding it
+        # doesn't cancel whatever else the caller's task is doing.
+        cancelled = threading.Event()
+        lookup = asyncio.ensure_future(
+            self.lookup_cascade(cancelled, query, options))
+        # abort the running statement, however the task was cancelled
+        lookup.add_done_callback(
+            lambda task: task.cancelled() and cancelled.set())
+
+        if key is not None:
+            previous = self.running.get(key)
+            if previous and not previous.done():
+                previous.cancel()
+            self.running[key] = lookup
+
+        try:
+            return await lookup
+        except asyncio.CancelledError:
+            # the caller was cancelled, or the lookup superseded
+            cancelled.set()
+            lookup.cancel()
+            raise
+        finally:
+            if key is not None and self.running.get(key) is lookup:
+                del self.running[key]
+
+    async def lookup_cascade(self, cancelled, query, options):
+        self.dictionary.refresh()
+        args, opts = self.dictionary.parse_options(query, options)
+        cs = args.case_sensitive
+
+        # for steps without limits
+        unlimited = database.Budget(cancelled=cancelled)
+
+        if opts['composite']:
+            # may do LIKE scans for kanji and readings
+            budget = database.Budget(opts['timeout'], opts['max_steps'],
+                                     cancelled)
+            ent_seqs = await self.run(True, budget, cs,
+                                      composite.search_composite,
+                                      args.query_s, args.extent, args.frequent,
+                                      opts['tags'], args.limit, args.offset)
+
+        elif args.query_s.strip():
+            # same as search.guess(), one condition at a time.
+            conditions = search.generate_search_conditions(args)
+            plan = await self.run(False, unlimited, cs,
+                                  planner.plan, conditions)
+            ent_seqs = []
+            for condition, cost in plan:
+                scan = (condition.is_scan()
+                        and cost >= planner.small_scan_rows)
+                try:
+                    res = await self.run(scan, condition.budget(cancelled), cs,
+                                         search.try_condition, condition)
+                except database.QueryTimeout as e:
+                    if not condition.skip_timeouts:
+                        raise
+                    condition.timed_out = str(e)
+                    continue
+                if res is not None:
+                    ent_seqs = res
+                    break
+
+        elif opts['tags']:
+            ent_seqs = await self.run(False, unlimited, cs,
+                                      search.search_by_tags,
+                                      opts['tags'], args.frequent,
+                                      args.limit, args.offset)
+        else:
+            ent_seqs = []
+
+        return await self.run(False, unlimited, cs,
+                              self.dictionary.fetch, ent_seqs)
@@ -0,0 +1,217 @@
+'''Annotation of running Japanese text.
+
+Text is segmented by longest match against all kebs and rebs in the
+database, left to right.  Each matched span is reported with the entries
+having that keb or reb.
+
+The lookup table (text -> ent_seqs) is built from kanjis and readings once,
+and cached on disk beside the database (see load_index()).
+'''
+
+import json
+import os
+import tempfile
+
+from myougiden import database
+from myougiden import orm
+
+class TextIndex():
+    '''All kebs and rebs, for longest-prefix matching.
+
+    Attributes:
+    - ent_seqs: dict of keb/reb -> tuple of ent_seqs, most frequent first.
+    - lengths: dict of first character -> tuple of the lengths of all
+      keys starting with it, longest first.
+
+    Instead of walking a trie, longest_match() tries only the key lengths
+    that exist for the character at hand; that's a few dict lookups per
+    position, and the index is no bigger than the dict of keys.
+    '''
+
+    def __init__(self, ent_seqs):
+        self.ent_seqs = ent_seqs
+
+        lengths = {}
+        for key in ent_seqs:
+            lengths.setdefault(key[0], set()).add(len(key))
+        self.lengths = {char: tuple(sorted(lens, reverse=True))
+                        for char, lens in lengths.items()}
+
+    def longest_match(self, text, start):
+        '''Return the longest key at text[start:], or None.'''
+
+        for length in self.lengths.get(text[start], ()):
+            key = text[start:start+length]
+            if key in self.ent_seqs:
+                return key
+        return None
+
+    def spans(self, text):
+        '''Yield (start, end, key) for each match in text, left to right.
+
+        Characters not starting any match are skipped.'''
+
+        pos = 0
+        end = len(text)
+        while pos < end:
+            key = self.longest_match(text, pos)
+            if key:
+                yield (pos, pos + len(key), key)
+                pos += len(key)
+            else:
+                pos += 1
+
+def build_index(cur):
+    '''Return TextIndex built from the database.'''
+
+    database.execute(cur, '''
+SELECT text, ent_seq
+FROM (
+  SELECT kanji AS text, ent_seq, freq_rank FROM kanjis
+  UNION
+  SELECT reading AS text, ent_seq, freq_rank FROM readings
+)
+ORDER BY freq_rank, ent_seq
+;''')
+
+    ent_seqs = {}
+    for text, ent_seq in cur:
+        ent_seqs.setdefault(text, []).append(ent_seq)
+    return TextIndex({text: tuple(seqs) for text, seqs in ent_seqs.items()})
+
+def index_stamp(cur):
+    '''Return a value that changes whenever the database is rebuilt.'''
+
+    database.execute(cur, 'SELECT dbversion, jmdict_mtime FROM versions;')
+    dbversion, jmdict_mtime = cur.fetchone()
+    return (dbversion, jmdict_mtime, os.path.getmtime(cur.connection.path))
+
+def cache_path(cur):
+    return cur.connection.path + '.annotate.json'
+
+def load_index(cur):
+    '''Return TextIndex, from the disk cache if it's up to date.
+
+    Otherwise build it, and try to save it to the cache (silently giving up
+    if the database directory isn't writable).
+
+    The cache is JSON of TextIndex.ent_seqs, not a pickle: the database
+    directory may be shared, and unpickling a file someone else wrote
+    would run their code.'''
+
+    stamp = list(index_stamp(cur))
+    try:
+        with open(cache_path(cur), 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached['stamp'] == stamp:
+            return TextIndex({text: tuple(seqs)
+                              for text, seqs in cached['ent_seqs'].items()})
+    except Exception:
+        # missing, corrupt or foreign; rebuild it
+        pass
+
+    index = build_index(cur)
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache_path(cur)))
+    except OSError:
+        return index
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'stamp': stamp, 'ent_seqs': index.ent_seqs}, f,
+                      ensure_ascii=False, separators=(',', ':'))
+        os.rename(tmp, cache_path(cur))
+    except OSError:
+        os.remove(tmp)
+    return index
+
+class Annotator():
+    '''Annotates lines of text with a TextIndex.
+
+    Entries are read from the database in batches, block_size lines at a
+    time, and each is read only once.  The output for each distinct word is also
+    only formatted once.'''
+
+    def __init__(self, cur, index):
+        self.cur = cur
+        self.index = index
+
+        # ent_seq -> Entry
+        self.entries = {}
+
+        # key -> formatted ent_seqs and glosses, per output format
+        self.tsv_cache = {}
+        self.json_cache = {}
+
+    def annotate(self, lines):
+        '''Yield (start, end, key) for each match in lines.
+
+        start and end are character offsets from the beginning of the first
+        line.'''
+
+        offset = 0
+        for block in blocks(lines):
+            spans = []
+            for line in block:
+                spans += [(offset + start, offset + end, key)
+                          for start, end, key in self.index.spans(line)]
+                offset += len(line)
+
+            missing = set()
+            for start, end, key in spans:
+                if key not in self.tsv_cache and key not in self.json_cache:
+                    missing.update(ent_seq
+                                   for ent_seq in self.index.ent_seqs[key]
+                                   if ent_seq not in self.entries)
+            missing = list(missing)
+            for i in range(0, len(missing), orm.fetch_batch_size):
+                for entry in orm.fetch_entries(self.cur,
+                                               missing[i:i+orm.fetch_batch_size]):
+                    self.entries[entry.ent_seq] = entry
+
+            for span in spans:
+                yield span
+
+    def key_entries(self, key):
+        return [self.entries[ent_seq] for ent_seq in self.index.ent_seqs[key]]
+
+    def format_tsv(self, start, end, key):
+        '''One line: start, end, text, ent_seqs, and first-sense glosses of
+        each entry (separated by ' / ').'''
+
+        if key not in self.tsv_cache:
+            entries = self.key_entries(key)
+            self.tsv_cache[key] = '%s\t%s' % (
+                ','.join(str(e.ent_seq) for e in entries),
+                ' / '.join('; '.join(first_glosses(e)) for e in entries))
+        return '%d\t%d\t%s\t%s' % (start, end, key, self.tsv_cache[key])
+
+    def format_json(self, start, end, key):
+        if key not in self.json_cache:
+            entries = self.key_entries(key)
+            self.json_cache[key] = json.dumps(
+                {'text': key,
+                 'ent_seqs': [e.ent_seq for e in entries],
+                 'glosses': [first_glosses(e) for e in entries]},
+                ensure_ascii=False,
+                separators=(',', ':'))[1:]
+        return '{"start":%d,"end":%d,%s' % (start, end, self.json_cache[key])
+
+# lines annotated at a time by Annotator.annotate()
+block_size = 100
+
+def blocks(lines):
+    '''Yield lists of up to block_size lines.'''
+
+    block = []
+    for line in lines:
+        block.append(line)
+        if len(block) >= block_size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+def first_glosses(entry):
+    if entry.senses:
+        return list(entry.senses[0].glosses)
+    return []
@@ -71,6 +71,18 @@ def coloredpb(string, color):
 def fmt(string, sty):
     return coloredp(string, *(style[sty]))
 
+def style_codes(sty):
+    '''Return (start, end) escape strings such that
+
+        start + string + end == fmt(string, sty)
+
+    Used to color many strings without calling termcolor for each one.'''
+
+    if not use_color:
+        return ('', '')
+    start, end = fmt('\0', sty).split('\0')
+    return (start, end)
+
 def percent(string, percent):
     if not use_color:
         return string
@@ -0,0 +1,304 @@
+'''Composite (boolean) queries, search engine style.
+
+Syntax:
+
+    tea ceremony          entries matching both terms (implicit AND)
+    tea OR coffee         entries matching either
+    tea NOT ceremony      'tea', but not 'ceremony' (also: tea -ceremony)
+    "tea ceremony"        phrase
+    (tea OR coffee) cup   grouping
+    k:茶 g:ceremony       field prefixes: k: kanji, r: reading, g: gloss
+
+Terms without a prefix match any field; rōmaji terms, though, only match
+glosses and the start of readings.  Operators must be uppercase.
+
+A query is parsed into a tree of Term, And, Or and Not nodes, and the tree
+is compiled into a single SQL statement that combines the ent_seqs of each
+term with INTERSECT, UNION and EXCEPT.
+'''
+
+import re
+
+from myougiden import database
+from myougiden import search
+from myougiden import texttools as tt
+
+class QuerySyntaxError(Exception):
+    '''Composite query could not be parsed.'''
+    pass
+
+field_prefixes = {
+    'k': 'kanji',
+    'kanji': 'kanji',
+    'r': 'reading',
+    'reading': 'reading',
+    'g': 'gloss',
+    'gloss': 'gloss',
+}
+
+class Term():
+    '''A word or phrase, to be looked up in field (or all, if None).'''
+    def __init__(self, text, field=None, phrase=False):
+        self.text = text
+        self.field = field
+        self.phrase = phrase
+
+    def __repr__(self):
+        return 'Term(%r, field=%r, phrase=%r)' % (self.text, self.field,
+                                                 self.phrase)
+
+class And():
+    def __init__(self, children):
+        self.children = children
+    def __repr__(self):
+        return 'And(%r)' % self.children
+
+class Or():
+    def __init__(self, children):
+        self.children = children
+    def __repr__(self):
+        return 'Or(%r)' % self.children
+
+class Not():
+    def __init__(self, child):
+        self.child = child
+    def __repr__(self):
+        return 'Not(%r)' % self.child
+
+token_regexp = re.compile(r'''
+    \s*(?:
+      (?P<paren>[()])
+    | (?P<neg>-)?
+      (?:(?P<field>[a-z]+):)?
+      (?: "(?P<phrase>[^"]*)"
+        | (?P<word>[^\s()"]+)
+      )
+    )''', re.X)
+
+def tokenize(string):
+    '''Return list of tokens: '(', ')', 'AND', 'OR', 'NOT', or Term().'''
+
+    tokens = []
+    pos = 0
+    string = string.strip()
+    while pos < len(string):
+        m = token_regexp.match(string, pos)
+        if not m or m.end() == pos:
+            raise QuerySyntaxError('unbalanced quotes at: %s' % string[pos:])
+        pos = m.end()
+
+        if m.group('paren'):
+            tokens.append(m.group('paren'))
+            continue
+
+        field = m.group('field')
+        if field:
+            if field not in field_prefixes:
+                raise QuerySyntaxError('unknown field: %s' % field)
+            field = field_prefixes[field]
+
+        if m.group('phrase') is not None:
+            term = Term(m.group('phrase'), field, phrase=True)
+        elif m.group('word') in ('AND', 'OR', 'NOT') and not field:
+            tokens.append(m.group('word'))
+            continue
+        else:
+            term = Term(m.group('word'), field)
+
+        if m.group('neg'):
+            tokens.append('NOT')
+        tokens.append(term)
+
+    return tokens
+
+def parse(string):
+    '''Parse composite query string; return tree of Term/And/Or/Not.
+
+    Raises QuerySyntaxError.'''
+
+    tokens = tokenize(string)
+    pos = 0
+
+    def peek():
+        if pos < len(tokens):
+            return tokens[pos]
+        return None
+
+    def advance():
+        nonlocal pos
+        pos += 1
+        return tokens[pos - 1]
+
+    def parse_or():
+        children = [parse_and()]
+        while peek() == 'OR':
+            advance()
+            children.append(parse_and())
+        if len(children) == 1:
+            return children[0]
+        return Or(children)
+
+    def parse_and():
+        children = [parse_not()]
+        while peek() not in (None, ')', 'OR'):
+            if peek() == 'AND':
+                advance()
+            children.append(parse_not())
+        if len(children) == 1:
+            return children[0]
+        return And(children)
+
+    def parse_not():
+        if peek() == 'NOT':
+            advance()
+            return Not(parse_not())
+        return parse_atom()
+
+    def parse_atom():
+        tok = peek()
+        if tok == '(':
+            advance()
+            node = parse_or()
+            if peek() != ')':
+                raise QuerySyntaxError('missing closing parenthesis')
+            advance()
+            return node
+        elif isinstance(tok, Term):
+            return advance()
+        elif tok is None:
+            raise QuerySyntaxError('query ended too soon')
+        else:
+            raise QuerySyntaxError('unexpected %s' % tok)
+
+    if not tokens:
+        raise QuerySyntaxError('empty query')
+    tree = parse_or()
+    if peek() is not None:
+        raise QuerySyntaxError('unexpected %s' % peek())
+    return tree
+
+def term_sql(term, extent):
+    '''Return (sql, params) selecting ent_seqs matching a Term.
+
+    extent is as in SearchConditions.  Kanji and readings match anywhere
+    in the field, unless extent is 'whole' or 'beginning'; glosses match
+    whole words (FTS), unless extent is 'whole', 'beginning' or 'partial'.
+
+    Rōmaji terms without a field never match kanji, and only match whole
+    readings or their beginning (both indexed), so that an English word
+    doesn't need a scan of the kanji and readings tables.
+    '''
+
+    latin = not term.field and tt.is_latin(term.text)
+    if term.field:
+        fields = (term.field,)
+    elif latin:
+        fields = ('reading', 'gloss')
+    else:
+        fields = ('kanji', 'reading', 'gloss')
+
+    selects = []
+    params = []
+    for field in fields:
+        text = term.text
+        column = field
+        if field == 'reading' and tt.is_latin(text):
+            # rōmaji readings are looked up in the Hepburn column
+            text = search.to_hepburn(text)
+            column = 'hepburn'
+
+        if latin and field == 'reading' and extent != 'whole':
+            selects.append('SELECT ent_seq FROM readings_fts WHERE hepburn MATCH ?')
+            params.append('"%s*"' % text.replace('"', ''))
+            continue
+
+        if field == 'gloss' and extent not in ('whole', 'beginning', 'partial'):
+            selects.append('SELECT ent_seq FROM glosses_fts WHERE gloss MATCH ?')
+            params.append('"%s"' % text.replace('"', ''))
+            continue
+
+        table = {'kanji': 'kanjis',
+                 'reading': 'readings',
+                 'gloss': 'glosses'}[field]
+        if extent == 'whole':
+            selects.append('SELECT ent_seq FROM %s WHERE %s = ?'
+                           % (table, column))
+            params.append(text)
+        else:
+            sql = ('SELECT ent_seq FROM %s WHERE %s %s'
+                   % (table, column, search.like_operator))
+            if extent == 'beginning':
+                params.append(search.like_escape(text) + '%')
+            else:
+                params.append('%' + search.like_escape(text) + '%')
+
+            if field == 'kanji':
+                chars_sql, chars_params = search.kanji_chars_where(text)
+                if chars_sql:
+                    sql += ' AND ' + chars_sql
+                    params += chars_params
+            selects.append(sql)
+
+    return ' UNION '.join(selects), params
+
+def compile_tree(node, extent):
+    '''Return (sql, params) selecting ent_seqs matching the parsed tree.'''
+
+    if isinstance(node, Term):
+        return term_sql(node, extent)
+
+    elif isinstance(node, Or):
+        parts = [compile_tree(child, extent) for child in node.children]
+        return (' UNION '.join('SELECT ent_seq FROM (%s)' % sql
+                               for sql, params in parts),
+                [p for sql, params in parts for p in params])
+
+    elif isinstance(node, Not):
+        sql, params = compile_tree(node.child, extent)
+        return ('SELECT ent_seq FROM entries EXCEPT SELECT ent_seq FROM (%s)'
+                % sql, params)
+
+    elif isinstance(node, And):
+        positives = [compile_tree(child, extent) for child in node.children
+                     if not isinstance(child, Not)]
+        negatives = [compile_tree(child.child, extent) for child in node.children
+                     if isinstance(child, Not)]
+
+        if positives:
+            sql = ' INTERSECT '.join('SELECT ent_seq FROM (%s)' % sql
+                                     for sql, params in positives)
+        else:
+            sql = 'SELECT ent_seq FROM entries'
+        for neg_sql, neg_params in negatives:
+            sql += ' EXCEPT SELECT ent_seq FROM (%s)' % neg_sql
+
+        return (sql, [p for sql, params in positives + negatives
+                      for p in params])
+
+def search_composite(cur, string, extent='auto', frequent=False, tags=(),
+                     limit=None, offset=0):
+    '''Run a composite query; return list of ent_seqs, most frequent first.
+
+    tags are as returned by search.tag_filters().'''
+
+    plan_sql, params = compile_tree(parse(string), extent)
+
+    where = 'ent_seq IN (%s)' % plan_sql
+    if frequent:
+        where += ' AND frequent = 1'
+    if tags:
+        tags_sql, tags_params = search.tags_where(tags)
+        where += ' AND ' + tags_sql
+        params += tags_params
+
+    page_sql, page_params = search.limit_sql(limit, offset)
+
+    database.execute(cur, '''
+SELECT ent_seq
+FROM entries
+WHERE %s
+ORDER BY freq_rank, ent_seq
+%s
+;''' % (where, page_sql), params + page_params)
+
+    return [row[0] for row in cur.fetchall()]
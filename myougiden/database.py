@@ -2,10 +2,20 @@ import os
 import re
 from glob import glob
 import sqlite3 as sql
+import struct
+import threading
+import time
+from urllib.request import pathname2url
+
+# optional; without it, old generations are collected as soon as the
+# system lets us delete them (see collect_generations()).
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from myougiden import config
 from myougiden.texttools import get_regexp
-from myougiden.color import fmt
 import myougiden.common
 
 def regexp_sensitive(pattern, field):
@@ -18,6 +28,22 @@ def regexp_insensitive(pattern, field):
     reg = get_regexp(pattern, re.I)
     return reg.search(field) is not None
 
+def match_score(matchinfo):
+    '''SQL hook function: relevance of an FTS row, higher is better.
+
+    Takes matchinfo() in the default 'pcx' format.  Sums, for each phrase
+    and column, the hits in this row divided by the hits in all rows; i.e.
+    matches of rare phrases count more.'''
+
+    ints = struct.unpack('@%dI' % (len(matchinfo) // 4), matchinfo)
+    phrases, columns = ints[0], ints[1]
+
+    score = 0.0
+    for i in range(2, 2 + 3 * phrases * columns, 3):
+        if ints[i]:
+            score += ints[i] / ints[i+1]
+    return score
+
 #def match_word_sensitive(word, field):
 #    '''SQL hook function for whole-word, case-sensitive, non-regexp matching.'''
 #
@@ -44,6 +70,101 @@ class DatabaseStaleUpdates(DatabaseAccessError):
     '''Temporary files left, updating process aborted anormally.'''
     pass
 
+class QueryTimeout(Exception):
+    '''A statement went over its Budget.'''
+    pass
+
+class Connection(sql.Connection):
+    '''sqlite3 connection, with the Budget of its statements (see
+    set_budget()), and the database generation it reads (see opendb()).'''
+
+    budget = None
+
+    # generation number (None for a database outside the generations
+    # directory), file path, and hold on the generation
+    generation = None
+    path = None
+    hold = None
+
+    def close(self):
+        super().close()
+        if self.hold is not None:
+            self.hold.close()
+            self.hold = None
+
+# SQLite virtual machine instructions between budget checks.
+budget_check_interval = 1000
+
+class Budget():
+    '''Limits on the work of the statements run under it.
+
+    seconds -- wall-clock time, counted from set_budget().
+    steps -- SQLite virtual machine instructions; roughly proportional to
+             the number of rows examined.
+    cancelled -- threading.Event; statements are aborted as soon as it's
+                 set (see cancel()).  A new one by default.
+
+    seconds and steps may be None, for no limit.
+
+    Statements going over seconds or steps raise QueryTimeout (see
+    execute()); cancelled ones, sqlite3.OperationalError.'''
+
+    def __init__(self, seconds=None, steps=None, cancelled=None):
+        self.seconds = seconds
+        self.steps = steps
+        self.cancelled = cancelled or threading.Event()
+        self.start()
+
+    def start(self):
+        '''Start counting time and steps from zero.'''
+
+        if self.seconds is None:
+            self.deadline = None
+        else:
+            self.deadline = time.monotonic() + self.seconds
+        self.used = 0
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def exceeded(self):
+        '''Return description of the limit gone over, or None.'''
+
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            return 'took longer than %gs' % self.seconds
+        if self.steps is not None and self.used > self.steps:
+            return 'took more than %d steps' % self.steps
+        return None
+
+    def check(self):
+        '''sqlite progress handler; True aborts the statement.'''
+
+        self.used += budget_check_interval
+        return self.cancelled.is_set() or self.exceeded() is not None
+
+def set_budget(con, budget):
+    '''Run the statements of con under budget (None for no limits).'''
+
+    con.budget = budget
+    if budget is None:
+        con.set_progress_handler(None, budget_check_interval)
+    else:
+        budget.start()
+        con.set_progress_handler(budget.check, budget_check_interval)
+
+def run_with_budget(cur, budget, function, *args):
+    '''Return function(cur, *args), with budget set for its statements.
+
+    If budget is None, just call function.'''
+
+    if budget is None:
+        return function(cur, *args)
+    set_budget(cur.connection, budget)
+    try:
+        return function(cur, *args)
+    finally:
+        set_budget(cur.connection, None)
+
 def test_database_tempfiles():
     '''Return values:
 
@@ -65,36 +186,222 @@ def test_database_tempfiles():
         return 'updating'
     return None
 
-def opendb(case_sensitive=False):
+# Database generations.
+#
+# updatedb-myougiden never overwrites a database in use.  Each build is
+# published as a new generation, a file N.sqlite in the generations
+# directory, and the 'current' file there is switched to N (atomically,
+# with a rename).  Long-running readers check the pointer before each
+# request (one stat(); see pointer_stamp()), and open the new generation
+# when it changes, while requests already running finish on the old one.
+#
+# Readers hold a shared lock on N.lock while connected to generation N;
+# old generations are deleted once nobody holds them (see
+# collect_generations()).  Databases built before generations existed are
+# still read from paths.database, until the first publish().
+
+def generations_dir():
+    return config.get('paths', 'generations')
+
+def pointer_path():
+    return os.path.join(generations_dir(), 'current')
+
+def generation_path(generation):
+    return os.path.join(generations_dir(), '%d.sqlite' % generation)
+
+def lock_path(generation):
+    return os.path.join(generations_dir(), '%d.lock' % generation)
+
+def list_generations():
+    '''Return sorted list of the generations in the directory.'''
+
+    try:
+        names = os.listdir(generations_dir())
+    except FileNotFoundError:
+        return []
+    matches = (re.match(r'([0-9]+)\.sqlite$', name) for name in names)
+    return sorted(int(m.group(1)) for m in matches if m)
+
+def current_generation():
+    '''Return the current generation, or None if none was published.'''
+
+    try:
+        with open(pointer_path()) as f:
+            return int(f.read())
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        raise DatabaseAccessError('Corrupt generation pointer ' + pointer_path())
+
+def pointer_stamp():
+    '''Return a value that changes whenever a generation is published.'''
+
+    try:
+        st = os.stat(pointer_path())
+    except FileNotFoundError:
+        return None
+    # the pointer is replaced, not rewritten, so the inode changes too
+    return (st.st_ino, st.st_mtime_ns)
+
+def current_path():
+    '''Return path of the current database file.'''
+
+    generation = current_generation()
+    if generation is None:
+        return config.get('paths', 'database')
+    return generation_path(generation)
+
+def hold_generation(generation):
+    '''Return open file holding a shared lock on generation, which keeps
+    collect_generations() off it until closed; or None if there's nothing
+    to lock.'''
+
+    if fcntl is None:
+        return None
+    try:
+        hold = open(lock_path(generation), 'rb')
+    except FileNotFoundError:
+        return None
+    fcntl.flock(hold, fcntl.LOCK_SH)
+    return hold
+
+def acquire_current():
+    '''Return (generation, path, hold) for the current database; see
+    hold_generation().'''
+
+    while True:
+        generation = current_generation()
+        if generation is None:
+            return None, config.get('paths', 'database'), None
+
+        hold = hold_generation(generation)
+        path = generation_path(generation)
+        if os.path.isfile(path) or current_generation() == generation:
+            return generation, path, hold
+
+        # collected before we got hold of it; the pointer has moved on
+        if hold:
+            hold.close()
+
+def publish(path):
+    '''Make database file at path the current generation, and return its
+    number.
+
+    The file is moved into the generations directory.  Old generations no
+    longer used are deleted, including the database of paths.database.'''
+
+    myougiden.common.mkdir_p(generations_dir())
+    generation = max(list_generations() + [current_generation() or 0]) + 1
+
+    # readers need it to exist, but may not be able to create it
+    open(lock_path(generation), 'ab').close()
+    os.rename(path, generation_path(generation))
+
+    # readers must never see a half-written pointer
+    new_pointer = '%s.%d' % (pointer_path(), os.getpid())
+    with open(new_pointer, 'w') as f:
+        f.write('%d\n' % generation)
+    os.replace(new_pointer, pointer_path())
+
+    # open connections keep working with the deleted file
+    for old in glob(config.get('paths', 'database') + '*'):
+        if not re.search(r'\.new\.[0-9]+$', old):
+            os.remove(old)
+
+    collect_generations()
+    return generation
+
+def collect_generations():
+    '''Delete generations older than the current one that no reader holds;
+    return the number of them left.
+
+    Errors (such as not having write access to the directory) are ignored;
+    the next call will try again.'''
+
+    current = current_generation()
+    if current is None:
+        return 0
+
+    for generation in list_generations():
+        if generation >= current:
+            continue
+
+        lock = None
+        try:
+            try:
+                lock = open(lock_path(generation), 'rb')
+            except FileNotFoundError:
+                pass
+            if lock and fcntl:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+            # database first: readers waiting on the lock check for it
+            for path in glob(generation_path(generation) + '*'):
+                os.remove(path)
+            if lock:
+                os.remove(lock_path(generation))
+        except OSError:
+            # in use, or not ours to delete
+            pass
+        finally:
+            if lock:
+                lock.close()
+
+    return len([generation for generation in list_generations()
+                if generation < current])
+
+def opendb(case_sensitive=False, readonly=False):
     '''Test and open SQL database; returns (con, cur).
 
+    The current generation is opened, and held until con is closed.  If
+    readonly, the database file is opened in read-only mode.
+
     Raises DatabaseAccessError subclass if database can't be used for any
     reason.'''
 
-    temps = test_database_tempfiles()
-    if temps == 'stale':
-        raise DatabaseStaleUpdates('updatedb-myougiden was interrupted; please run again')
-    elif temps == 'updating':
-        print("%s: updatedb-myougiden is running, please wait a while :)" %
-              fmt('WARNING', 'warning'))
+    generation, path, hold = acquire_current()
 
-    if not os.path.isfile(config.get('paths','database')):
-        raise DatabaseMissing('Could not find ' + config.get('paths','database'))
+    # an update in progress doesn't affect the current generation.
+    if not os.path.isfile(path):
+        if hold:
+            hold.close()
+        temps = test_database_tempfiles()
+        if temps == 'stale':
+            raise DatabaseStaleUpdates('updatedb-myougiden was interrupted; please run again')
+        elif temps == 'updating':
+            raise DatabaseMissing('updatedb-myougiden is still building the database; please wait a while :)')
+        raise DatabaseMissing('Could not find ' + path)
 
     try:
-        con = sql.connect(config.get('paths','database'))
+        if readonly:
+            con = sql.connect('file:%s?mode=ro' % pathname2url(path),
+                              uri=True, factory=Connection)
+        else:
+            con = sql.connect(path, factory=Connection)
         cur = con.cursor()
     except sql.OperationalError as e:
+        if hold:
+            hold.close()
         raise DatabaseAccessError(str(e))
+    con.generation = generation
+    con.path = path
+    con.hold = hold
 
     try:
-        execute(cur, ('SELECT dbversion FROM versions;'))
-        dbversion = cur.fetchone()[0]
-    except sql.OperationalError:
-        raise DatabaseAccessError("Couldn't read database to check version")
+        try:
+            execute(cur, ('SELECT dbversion FROM versions;'))
+            dbversion = cur.fetchone()[0]
+        except sql.OperationalError:
+            raise DatabaseAccessError("Couldn't read database to check version")
+
+        if dbversion != config.get('core','dbversion'):
+            raise DatabaseWrongVersion('Incorrect database version: %s' % dbversion)
+    except DatabaseAccessError:
+        # also releases the hold on the generation
+        con.close()
+        raise
 
-    if dbversion != config.get('core','dbversion'):
-        raise DatabaseWrongVersion('Incorrect database version: %s' % dbversion)
+    con.create_function('match_score', 1, match_score)
 
     if case_sensitive:
         con.create_function('regexp', 2, regexp_sensitive)
@@ -110,4 +417,11 @@ def opendb(case_sensitive=False):
 def execute(cur, *args):
     if myougiden.common.debug:
         print(*args)
-    cur.execute(*args)
+    try:
+        cur.execute(*args)
+    except sql.OperationalError:
+        # interrupted by the progress handler?
+        budget = getattr(cur.connection, 'budget', None)
+        if budget is not None and budget.exceeded():
+            raise QueryTimeout('search %s' % budget.exceeded())
+        raise
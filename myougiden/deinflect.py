@@ -0,0 +1,233 @@
+'''Rule-based deinflection of Japanese verbs and adjectives.
+
+candidates('行かなかった') returns the possible dictionary forms of the
+query, e.g. '行く', each with the set of JMdict part-of-speech tags
+(orm.sense_tag_kinds 'pos') that a matching entry must have.
+
+Rules are suffix rewrites.  Some inflected forms can be inflected again
+(行かない conjugates like an i-adjective), so rules are applied
+repeatedly; a rule only applies to a word of one of its input classes.
+'''
+
+from myougiden import database
+from myougiden import search
+
+class Rule():
+    '''Rewrite suffix inflected to base.
+
+    ins: classes the inflected form must belong to; None if the rule only
+         applies to the query itself (the form can't be inflected again).
+    outs: classes of the base form (JMdict pos abbreviations).
+    '''
+
+    __slots__ = ('inflected', 'base', 'ins', 'outs', 'reason')
+
+    def __init__(self, inflected, base, ins, outs, reason):
+        self.inflected = inflected
+        self.base = base
+        self.ins = ins
+        self.outs = outs
+        self.reason = reason
+
+# godan verbs: base ending, a/i/e/o stems, te and ta forms, pos tags.
+godan = (
+    ('う', 'わ', 'い', 'え', 'お', 'って', 'った', ('v5u', 'v5u-s')),
+    ('く', 'か', 'き', 'け', 'こ', 'いて', 'いた', ('v5k',)),
+    ('く', 'か', 'き', 'け', 'こ', 'って', 'った', ('v5k-s',)),
+    ('ぐ', 'が', 'ぎ', 'げ', 'ご', 'いで', 'いだ', ('v5g',)),
+    ('す', 'さ', 'し', 'せ', 'そ', 'して', 'した', ('v5s',)),
+    ('つ', 'た', 'ち', 'て', 'と', 'って', 'った', ('v5t',)),
+    ('ぬ', 'な', 'に', 'ね', 'の', 'んで', 'んだ', ('v5n',)),
+    ('ぶ', 'ば', 'び', 'べ', 'ぼ', 'んで', 'んだ', ('v5b',)),
+    ('む', 'ま', 'み', 'め', 'も', 'んで', 'んだ', ('v5m',)),
+    ('る', 'ら', 'り', 'れ', 'ろ', 'って', 'った', ('v5r', 'v5r-i', 'v5aru')),
+)
+
+# ichidan-like verbs: base ending, stems for each form, pos tags.  the
+# dict maps form name -> stem; missing forms are the plain stem.  'pot' is
+# the whole potential form, None if it's irregular (see make_rules()).
+ichidan = (
+    ('る', {}, ('v1', 'v1-s')),
+    ('くる', {'a': 'こ', 'i': 'き', 'e': 'くれ', 'o': 'こ', 'imp': 'こい'},
+     ('vk',)),
+    ('来る', {'a': '来', 'i': '来', 'e': '来れ', 'o': '来', 'imp': '来い'},
+     ('vk',)),
+    ('する', {'a': 'し', 'i': 'し', 'e': 'すれ', 'o': 'し', 'imp': 'しろ',
+             'pass': 'さ', 'caus': 'さ', 'pot': None},
+     ('vs-i', 'vs-s')),
+)
+
+v1_like = ('v1',)
+adj_i = ('adj-i',)
+
+def verb_rules(base, a, i, e, o, te, ta, imp, passive, causative,
+               potential, outs):
+    '''Return rules for a verb class, given its stems and endings.
+
+    potential may be None, if the class has no regular potential form.'''
+
+    def rule(inflected, ins, reason):
+        return Rule(inflected, base, ins, outs, reason)
+
+    rules = [
+        rule(ta, None, 'past'),
+        rule(te, None, '-te'),
+        rule(ta + 'ら', None, '-tara'),
+        rule(ta + 'り', None, '-tari'),
+        rule(e + 'ば', None, 'provisional'),
+        rule(o + 'う', None, 'volitional'),
+        rule(imp, None, 'imperative'),
+        rule(i + 'ます', None, 'polite'),
+        rule(i + 'ました', None, 'polite past'),
+        rule(i + 'ません', None, 'polite negative'),
+        rule(i + 'ませんでした', None, 'polite past negative'),
+        rule(i + 'ましょう', None, 'polite volitional'),
+        rule(a + 'ず', None, '-zu'),
+        rule(a + 'ない', adj_i, 'negative'),
+        rule(i + 'たい', adj_i, '-tai'),
+        rule(passive, v1_like, 'passive'),
+        rule(causative, v1_like, 'causative'),
+        rule(te + 'いる', v1_like, '-te iru'),
+        rule(te + 'る', v1_like, '-te iru'),
+        rule(te + 'しまう', ('v5u',), '-te shimau'),
+    ]
+    if potential:
+        rules.append(rule(potential, v1_like, 'potential'))
+    return rules
+
+def make_rules():
+    rules = []
+    for base, a, i, e, o, te, ta, outs in godan:
+        rules += verb_rules(base, a, i, e, o, te, ta,
+                            imp=e,
+                            passive=a + 'れる',
+                            causative=a + 'せる',
+                            potential=e + 'る',
+                            outs=outs)
+
+    for base, stems, outs in ichidan:
+        stem = base[:-1]
+        if base == 'る':
+            stem = ''
+        a = stems.get('a', stem)
+        i = stems.get('i', stem)
+        rules += verb_rules(base, a, i,
+                            e=stems.get('e', stem + 'れ'),
+                            o=stems.get('o', stem + 'よ'),
+                            te=i + 'て',
+                            ta=i + 'た',
+                            imp=stems.get('imp', stem + 'ろ'),
+                            passive=stems.get('pass', a + 'ら') + 'れる',
+                            causative=stems.get('caus', a + 'さ') + 'せる',
+                            potential=stems.get('pot', a + 'られる'),
+                            outs=outs)
+
+    # suru-nouns: 勉強する -> 勉強
+    rules.append(Rule('する', '', ('vs-i',), ('vs',), 'suru'))
+    # potential of する: 勉強できる -> 勉強する
+    rules.append(Rule('できる', 'する', v1_like, ('vs-i',), 'potential'))
+
+    for base, stem, outs in (('い', '', ('adj-i',)),
+                             ('いい', 'よ', ('adj-ix',))):
+        rules += [
+            Rule(stem + 'かった', base, None, outs, 'past'),
+            Rule(stem + 'くない', base, adj_i, outs, 'negative'),
+            Rule(stem + 'くて', base, None, outs, '-te'),
+            Rule(stem + 'ければ', base, None, outs, 'provisional'),
+            Rule(stem + 'かろう', base, None, outs, 'volitional'),
+            Rule(stem + 'く', base, None, outs, 'adverbial'),
+            Rule(stem + 'さ', base, None, outs, 'noun'),
+        ]
+
+    # longest suffixes first
+    rules.sort(key=lambda rule: -len(rule.inflected))
+    return rules
+
+rules = make_rules()
+
+# maximum number of rules applied in a row
+max_depth = 5
+
+def candidates(word):
+    '''Return dict of possible dictionary form -> set of pos abbrevs.
+
+    The query itself is not included.'''
+
+    found = {}
+    # queue of (text, classes); classes None means 'the query itself'
+    queue = [(word, None, 0)]
+    seen = set()
+    while queue:
+        text, classes, depth = queue.pop()
+        if depth >= max_depth:
+            continue
+
+        for rule in rules:
+            if not text.endswith(rule.inflected):
+                continue
+            if classes is not None and not (rule.ins and set(rule.ins) & classes):
+                continue
+
+            base = text[:len(text) - len(rule.inflected)] + rule.base
+            if not base or base == word:
+                continue
+
+            outs = set(rule.outs)
+            found.setdefault(base, set()).update(outs)
+
+            key = (base, frozenset(outs))
+            if key not in seen:
+                seen.add(key)
+                queue.append((base, outs, depth + 1))
+
+    return found
+
+def search_inflected(cur, cond):
+    '''search_by() for cond.extent == 'inflected'.
+
+    Looks up all dictionary forms of cond.query_s at once, in kanjis and
+    readings (indexed), and keeps entries with a matching pos.  Return list
+    of ent_seqs, most frequent first.'''
+
+    forms = candidates(cond.query_s)
+    if not forms:
+        return []
+
+    texts = list(forms)
+    marks = ','.join('?' * len(texts))
+    database.execute(cur, '''
+SELECT text, matches.ent_seq, abbrev
+FROM (
+  SELECT kanji AS text, ent_seq FROM kanjis WHERE kanji IN (%s)
+  UNION
+  SELECT reading AS text, ent_seq FROM readings WHERE reading IN (%s)
+) AS matches
+JOIN sense_tags ON sense_tags.ent_seq = matches.ent_seq
+JOIN abbreviations ON abbreviations.abbrev_id = sense_tags.abbrev_id
+WHERE kind = 'pos'
+;''' % (marks, marks), texts + texts)
+
+    ent_seqs = set(ent_seq for text, ent_seq, abbrev in cur.fetchall()
+                   if abbrev in forms[text])
+    if not ent_seqs:
+        return []
+
+    where = 'ent_seq IN (%s)' % ','.join('?' * len(ent_seqs))
+    params = list(ent_seqs)
+    if cond.frequent:
+        where += ' AND frequent = 1'
+    if cond.tags:
+        tags_sql, tags_params = search.tags_where(cond.tags)
+        where += ' AND ' + tags_sql
+        params += tags_params
+
+    page_sql, page_params = search.limit_sql(cond.limit, cond.offset)
+    database.execute(cur, '''
+SELECT ent_seq
+FROM entries
+WHERE %s
+ORDER BY freq_rank, ent_seq
+%s
+;''' % (where, page_sql), params + page_params)
+
+    return [row[0] for row in cur.fetchall()]
@@ -0,0 +1,385 @@
+'''Library interface to myougiden.
+
+    >>> from myougiden import Dictionary
+    >>> d = Dictionary(limit=5)
+    >>> for entry in d.lookup('chanoyu'):
+    ...     print(entry.ent_seq, [r.text for r in entry.readings])
+
+A Dictionary can be shared among threads.  Each thread gets its own
+read-only database connections, opened on first use.
+
+When updatedb-myougiden publishes a new database, lookups started from then
+on use it, without restarting (see refresh()).
+
+With Dictionary(speculate=N), guesses that get to the slow tiers (table
+scans) run up to N following tiers at the same time, in worker threads,
+instead of one after the other.  A miss then takes about as long as its
+slowest tier, instead of the sum of all of them; the tiers still running
+when a result is chosen are aborted.
+'''
+
+import collections
+import gc
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from myougiden import composite
+from myougiden import database
+from myougiden import orm
+from myougiden import planner
+from myougiden import search
+
+class Dictionary():
+    '''The JMdict database, ready for lookups.
+
+    speculate -- number of guess() tiers run ahead of time, in parallel
+    (see above); 0 to run them one at a time.
+
+    Other keyword arguments are default options for lookup(); see there.'''
+
+    # option -> default value
+    option_defaults = {
+        'field': 'auto',
+        'extent': 'auto',
+        'regexp': False,
+        'case_sensitive': None,
+        'frequent': False,
+        'tags': (),
+        'limit': None,
+        'offset': 0,
+        'composite': False,
+        'timeout': None,
+        'max_steps': None,
+        'skip_timeouts': False,
+    }
+
+    def __init__(self, speculate=0, **defaults):
+        for option in defaults:
+            if option not in self.option_defaults:
+                raise TypeError('unknown option: %s' % option)
+
+        self.defaults = dict(self.option_defaults)
+        self.defaults.update(defaults)
+
+        self.local = threading.local()
+
+        # see refresh().  Each thread reopens its connections when its own
+        # epoch falls behind.
+        self.lock = threading.Lock()
+        self.stamp = database.pointer_stamp()
+        self.epoch = 0
+        # time of the next collect(), while old generations are left
+        self.next_collect = None
+
+        self.speculate = speculate
+        if speculate:
+            self.executor = ThreadPoolExecutor(speculate + 1)
+        else:
+            self.executor = None
+
+        # test database now, so that errors come up early.  Not kept, since
+        # this thread may never look anything up, and would hold on to the
+        # generation forever.
+        con, cur = database.opendb(readonly=True)
+        con.close()
+
+    def cursor(self, case_sensitive):
+        '''Return cursor for the current thread.
+
+        Case sensitivity is a per-connection setting (see
+        database.opendb()), so each thread has up to two connections.'''
+
+        cursors = getattr(self.local, 'cursors', None)
+        if cursors is None:
+            cursors = self.local.cursors = {}
+
+        epoch = self.epoch
+        if getattr(self.local, 'epoch', epoch) != epoch:
+            # not closed, since a lookup or iter_entries() may still be
+            # using them; the old generation is released when they're
+            # gone.
+            cursors.clear()
+            self.collect()
+        self.local.epoch = epoch
+
+        if case_sensitive not in cursors:
+            con, cur = database.opendb(case_sensitive=case_sensitive,
+                                       readonly=True)
+            cursors[case_sensitive] = cur
+        return cursors[case_sensitive]
+
+    def refresh(self):
+        '''Switch to the current database generation, if a new one was
+        published since the last call (see database.publish()).
+
+        Costs one stat().  Each thread switches its connections on its next
+        use of the database; lookups already running finish on the old
+        generation.'''
+
+        stamp = database.pointer_stamp()
+        if stamp != self.stamp:
+            with self.lock:
+                if stamp != self.stamp:
+                    self.stamp = stamp
+                    self.epoch += 1
+                    self.next_collect = time.monotonic()
+        if (self.next_collect is not None
+            and time.monotonic() >= self.next_collect):
+            self.collect()
+
+    # seconds between tries to delete old generations still in use
+    collect_interval = 60
+
+    def collect(self):
+        '''Delete old generations no longer used (see
+        database.collect_generations()); if some are left, try again from
+        refresh() later.'''
+
+        # sqlite3 connections are in reference cycles, so those of ended
+        # threads are only freed (and release their generation) here.
+        gc.collect()
+        if database.collect_generations():
+            self.next_collect = time.monotonic() + self.collect_interval
+        else:
+            self.next_collect = None
+
+    def close(self):
+        '''Close the database connections of the current thread, and stop
+        the speculation workers.
+
+        Connections of other threads are closed when those threads end.'''
+
+        cursors = getattr(self.local, 'cursors', {})
+        for cur in cursors.values():
+            cur.connection.close()
+        cursors.clear()
+
+        if self.executor:
+            self.executor.shutdown()
+
+    def run_cancellable(self, budget, case_sensitive, function, *args):
+        '''Run function(cur, *args) in the current thread, under budget.
+
+        The statement is aborted (with sqlite3.OperationalError) as soon as
+        the budget is cancelled; see database.Budget.'''
+
+        return database.run_with_budget(self.cursor(case_sensitive), budget,
+                                        function, *args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def parse_options(self, query, options):
+        '''Return (args, opts) for a lookup.
+
+        opts is a dict of all options (defaults updated with options); args
+        is as returned by search.make_args().'''
+
+        opts = dict(self.defaults)
+        opts.update(options)
+        for option in opts:
+            if option not in self.option_defaults:
+                raise TypeError('unknown option: %s' % option)
+
+        args = search.make_args(query,
+                                field=opts['field'],
+                                extent=opts['extent'],
+                                regexp=opts['regexp'],
+                                case_sensitive=opts['case_sensitive'],
+                                frequent=opts['frequent'],
+                                tags=opts['tags'],
+                                limit=opts['limit'],
+                                offset=opts['offset'],
+                                timeout=opts['timeout'],
+                                max_steps=opts['max_steps'],
+                                skip_timeouts=opts['skip_timeouts'])
+        return args, opts
+
+    def find(self, query, **options):
+        '''Return (cursor, list of ent_seqs) matching query.'''
+
+        self.refresh()
+        args, opts = self.parse_options(query, options)
+        cur = self.cursor(args.case_sensitive)
+
+        if opts['composite']:
+            # a single search; over the limits, it can only fail.
+            budget = None
+            if opts['timeout'] is not None or opts['max_steps'] is not None:
+                budget = database.Budget(opts['timeout'], opts['max_steps'])
+            ent_seqs = database.run_with_budget(cur, budget,
+                                                composite.search_composite,
+                                                args.query_s, args.extent,
+                                                args.frequent, opts['tags'],
+                                                args.limit, args.offset)
+        elif args.query_s.strip():
+            conditions = search.generate_search_conditions(args)
+            chosen_conds, ent_seqs = self.guess(conditions,
+                                                args.case_sensitive)
+        elif opts['tags']:
+            ent_seqs = search.search_by_tags(cur, opts['tags'], args.frequent,
+                                             args.limit, args.offset)
+        else:
+            ent_seqs = []
+
+        return cur, ent_seqs
+
+    def lookup(self, query, **options):
+        '''Return list of Entry objects matching query, best first.
+
+        query is a string (or a list of strings, like command-line
+        arguments).  Options:
+
+        - field: 'kanji', 'reading', 'gloss', or 'auto' (guess).
+        - extent: 'whole', 'beginning', 'word', 'partial', 'fuzzy', or
+          'auto'.
+        - regexp: query is a regular expression.
+        - case_sensitive: True, False, or None (guess from query).
+        - frequent: only frequent words.
+        - tags: list of (kind, abbrev) sense tags, like [('pos', 'v5k')].
+        - limit, offset: page of results.
+        - composite: query is a composite query (see myougiden.composite).
+        - timeout, max_steps: limits on each search tried, in seconds and
+          in SQLite steps (see database.Budget); None for no limit.
+        - skip_timeouts: if a search goes over the limits, go on to the next
+          one instead of raising database.QueryTimeout.
+
+        Raises composite.QuerySyntaxError for bad composite queries.'''
+
+        cur, ent_seqs = self.find(query, **options)
+        return self.fetch(cur, ent_seqs)
+
+    def lookup_many(self, queries, **options):
+        '''Return a list of results of lookup(), one per query.
+
+        Queries whose first guess is a whole kanji or reading match (i.e.
+        most Japanese words) are tried all at once, with one SQL statement
+        per field; only the ones not found there go through the rest of
+        the guess() cascade.  Entries found by several queries are only
+        read once.'''
+
+        self.refresh()
+        cur = self.cursor(False)
+        opts = self.parse_options('', options)[1]
+        found = [None] * len(queries)
+
+        # field -> term -> list of (query index, conditions, args)
+        batches = {'kanji': {}, 'reading': {}}
+        for i, query in enumerate(queries):
+            args = self.parse_options(query, options)[0]
+            if opts['composite'] or not args.query_s.strip():
+                found[i] = self.find(query, **options)
+                continue
+
+            conditions = search.generate_search_conditions(args)
+            conditions.sort(key=lambda cond: cond.sort_key())
+            first = conditions[0]
+            if (first.field in batches and first.extent == 'whole'
+                and not first.regexp and not first.romaji):
+                batches[first.field].setdefault(first.query_s, []).append(
+                    (i, conditions, args))
+            else:
+                found[i] = self.find(query, **options)
+
+        for field, terms in batches.items():
+            if not terms:
+                continue
+            hits = search.search_whole_batch(cur, field, terms.keys(),
+                                             frequent=opts['frequent'],
+                                             tags=opts['tags'])
+            for term, pending in terms.items():
+                for i, conditions, args in pending:
+                    if term in hits:
+                        res = hits[term][args.offset:]
+                        if args.limit is not None:
+                            res = res[:args.limit]
+                        found[i] = (cur, res)
+                    else:
+                        found[i] = (self.cursor(args.case_sensitive),
+                                    self.guess(conditions[1:],
+                                               args.case_sensitive)[1])
+
+        entries = {}
+        for qcur, ent_seqs in found:
+            missing = [ent_seq for ent_seq in ent_seqs
+                       if ent_seq not in entries]
+            for entry in self.fetch(qcur, missing):
+                entries[entry.ent_seq] = entry
+
+        return [[entries[ent_seq] for ent_seq in ent_seqs]
+                for qcur, ent_seqs in found]
+
+    def guess(self, conditions, case_sensitive):
+        '''Like search.guess(), with speculation if enabled.
+
+        Cheap conditions (see planner.cost()) run one at a time in the
+        current thread.  From the first expensive one on, up to speculate
+        + 1 conditions run at once in the workers; the result of a
+        condition is used as soon as all the ones before it came back
+        empty.'''
+
+        cur = self.cursor(case_sensitive)
+        if not self.speculate:
+            return search.guess(cur, conditions)
+
+        def outcome(condition, future=None):
+            '''Result of try_condition(), None if it timed out and may be
+            skipped.'''
+            try:
+                if future:
+                    return future.result()
+                return database.run_with_budget(cur, condition.budget(),
+                                                search.try_condition,
+                                                condition)
+            except database.QueryTimeout as e:
+                if not condition.skip_timeouts:
+                    raise
+                condition.timed_out = str(e)
+                return None
+
+        plan = collections.deque(planner.plan(cur, conditions))
+        # (condition, future, budget), in plan order
+        running = collections.deque()
+        try:
+            while plan or running:
+                if not running and plan[0][1] < planner.small_scan_rows:
+                    condition, cost = plan.popleft()
+                    res = outcome(condition)
+                else:
+                    while plan and len(running) <= self.speculate:
+                        condition, cost = plan.popleft()
+                        budget = condition.budget(threading.Event())
+                        future = self.executor.submit(
+                            self.run_cancellable, budget, case_sensitive,
+                            search.try_condition, condition)
+                        running.append((condition, future, budget))
+                    condition, future, budget = running.popleft()
+                    res = outcome(condition, future)
+
+                if res is not None:
+                    return (condition, res)
+            return (None, [])
+        finally:
+            # abort speculation that turned out useless
+            for condition, future, budget in running:
+                budget.cancel()
+                future.cancel()
+
+    def fetch(self, cur, ent_seqs):
+        '''Return list of Entry objects for ent_seqs, in order.'''
+
+        entries = []
+        for i in range(0, len(ent_seqs), orm.fetch_batch_size):
+            entries += orm.fetch_entries(cur,
+                                         ent_seqs[i:i+orm.fetch_batch_size])
+        return entries
+
+    def iter_entries(self, frequent=False, tags=()):
+        '''Yield all entries, in JMdict order; see orm.iter_entries().'''
+
+        self.refresh()
+        return orm.iter_entries(self.cursor(False), frequent, tags)
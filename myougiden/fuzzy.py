@@ -0,0 +1,184 @@
+'''Typo-tolerant search, the last resort of guess().
+
+Distinct kebs, Hepburn readings and gloss words are indexed by their
+n-grams (fuzzy_terms and fuzzy_grams tables; see updatedb-myougiden).  A
+query looks up terms sharing enough n-grams with it, in a single indexed
+statement, and only those few candidates are compared to the query by edit
+distance.
+
+A term within edit distance k of the query shares at least (number of
+distinct n-grams of the query) - k * n of them (each edit destroys at most
+n), so candidates can be filtered in SQL before any distance is computed.
+'''
+
+from myougiden import database
+from myougiden import search
+from myougiden import texttools as tt
+
+def gram_size(field):
+    '''n-gram size for terms of field; kebs are short, so they get
+    bigrams.'''
+
+    if field == 'kanji':
+        return 2
+    else:
+        return 3
+
+pad = '\x00'
+
+def grams(field, string):
+    '''Return set of n-grams of string, padded at both ends.'''
+
+    n = gram_size(field)
+    padded = pad * (n - 1) + string + pad * (n - 1)
+    return set(padded[i:i+n] for i in range(len(padded) - n + 1))
+
+def max_distance(string):
+    '''Number of typos tolerated in a query.'''
+
+    if len(string) <= 4:
+        return 1
+    else:
+        return 2
+
+# number of terms (per field) compared to the query by edit distance.
+candidate_limit = 200
+
+# number of entries returned, unless a smaller limit is asked for.
+max_results = 50
+
+def distance(a, b):
+    '''Levenshtein distance between strings a and b.'''
+
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+def fuzzy_term(cond):
+    '''Return the string to look up for cond, or None if the field can't be
+    searched fuzzily.
+
+    Readings are compared in Hepburn, where a typo is one letter; glosses
+    are searched one word at a time, so only one-word queries work.  Terms
+    shorter than gram_size() are too short to have typos.'''
+
+    query = cond.query_s.strip()
+    if cond.field == 'reading':
+        term = search.to_hepburn(query).replace(' ', '')
+    elif cond.field == 'gloss':
+        words = tt.words(query)
+        if len(words) != 1:
+            return None
+        term = words[0].lower()
+    else:
+        term = query
+
+    if len(term) < gram_size(cond.field):
+        return None
+    return term
+
+def similar_terms(cur, field, term):
+    '''Return list of (distance, term) for the terms of field similar to
+    term, closest first.'''
+
+    k = max_distance(term)
+    query_grams = grams(field, term)
+    min_shared = max(1, len(query_grams) - k * gram_size(field))
+
+    marks = ','.join('?' * len(query_grams))
+    database.execute(cur, '''
+SELECT term
+FROM (
+  SELECT term_id, count(*) AS shared
+  FROM fuzzy_grams
+  WHERE field = ? AND gram IN (%s)
+  GROUP BY term_id
+  HAVING shared >= ?
+) AS candidates
+JOIN fuzzy_terms USING (term_id)
+WHERE length BETWEEN ? AND ?
+ORDER BY shared DESC, length
+LIMIT ?
+;''' % marks,
+                     [field] + list(query_grams)
+                     + [min_shared, len(term) - k, len(term) + k,
+                        candidate_limit])
+
+    found = []
+    for (candidate,) in cur.fetchall():
+        folded = candidate.lower() if field == 'gloss' else candidate
+        d = distance(term, folded)
+        if d <= k:
+            found.append((d, candidate))
+    found.sort()
+    return found
+
+def search_fuzzy(cur, cond):
+    '''search_by() for cond.extent == 'fuzzy'.
+
+    Return list of ent_seqs having a term of cond.field close to the query,
+    closest first, then most frequent first; at most max_results (or
+    cond.limit).  The matched terms are saved in cond.matched_terms, for
+    search.matched_regexp().'''
+
+    term = fuzzy_term(cond)
+    if not term:
+        return []
+    similar = similar_terms(cur, cond.field, term)
+    cond.matched_terms = [t for d, t in similar]
+    if not similar:
+        return []
+
+    distances = {}
+    for d, t in similar:
+        distances.setdefault(t, d)
+
+    if cond.field == 'kanji':
+        matches = 'SELECT kanji AS term, ent_seq FROM kanjis WHERE kanji IN (%s)'
+    elif cond.field == 'reading':
+        matches = 'SELECT hepburn AS term, ent_seq FROM readings WHERE hepburn IN (%s)'
+    else:
+        matches = '''SELECT word AS term, ent_seq
+  FROM gloss_words
+  JOIN glosses ON glosses.gloss_id = gloss_words.gloss_id
+  WHERE word IN (%s)'''
+    matches = matches % ','.join('?' * len(distances))
+
+    where = '1'
+    params = list(distances)
+    if cond.frequent:
+        where += ' AND frequent = 1'
+    if cond.tags:
+        tags_sql, tags_params = search.tags_where(cond.tags)
+        where += ' AND ' + tags_sql
+        params += tags_params
+
+    database.execute(cur, '''
+SELECT term, ent_seq, freq_rank
+FROM (
+  %s
+) AS matches
+JOIN entries USING (ent_seq)
+WHERE %s
+;''' % (matches, where), params)
+
+    # ent_seq -> (distance, freq_rank, ent_seq)
+    ranks = {}
+    for t, ent_seq, freq_rank in cur.fetchall():
+        rank = (distances[t], freq_rank, ent_seq)
+        if ent_seq not in ranks or rank < ranks[ent_seq]:
+            ranks[ent_seq] = rank
+
+    limit = max_results
+    if cond.limit is not None:
+        limit = min(limit, cond.limit)
+    ranked = sorted(ranks.values())[cond.offset:cond.offset + limit]
+    return [ent_seq for d, freq_rank, ent_seq in ranked]
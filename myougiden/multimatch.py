@@ -0,0 +1,110 @@
+'''Partial search for many terms at once.
+
+Looking up thousands of terms with extent 'partial' would mean thousands of
+full table scans (LIKE can't use an index).  Instead, we build an
+Aho-Corasick automaton from all terms, and read each table only once,
+feeding every field through the automaton.
+'''
+
+from myougiden import database
+
+class Automaton():
+    '''Aho-Corasick automaton matching a set of strings.
+
+    States are numbered; 0 is the root.  For each state:
+    - goto[state]: dict of character -> next state.
+    - fail[state]: state for the longest proper suffix that is also in the
+      trie.
+    - out[state]: tuple of terms ending at this state (including those of
+      fail states).
+    '''
+
+    def __init__(self, terms):
+        self.goto = [{}]
+        out = [set()]
+
+        for term in terms:
+            state = 0
+            for char in term:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    out.append(set())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            out[state].add(term)
+
+        # breadth-first, so that fail states are done before their users
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, child in self.goto[state].items():
+                queue.append(child)
+
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                if fail == child:
+                    fail = 0
+                self.fail[child] = fail
+                out[child] |= out[fail]
+
+        self.out = [tuple(terms) for terms in out]
+
+    def search(self, text):
+        '''Return set of terms occurring in text.'''
+
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+def search_partial_many(cur, terms, fields=('kanji', 'reading', 'gloss'),
+                        case_sensitive=False, frequent=False):
+    '''Yield (term, ent_seq) for each entry having term anywhere in fields.
+
+    Like search_by() with extent 'partial' for each term, but each table is
+    read once, however many terms there are.  Each pair is yielded once.
+    Unless case_sensitive, case is folded (for all characters, unlike
+    LIKE).'''
+
+    terms = set(term for term in terms if term)
+    if not case_sensitive:
+        # folded -> original terms
+        originals = {}
+        for term in terms:
+            originals.setdefault(term.lower(), []).append(term)
+        automaton = Automaton(originals.keys())
+    else:
+        automaton = Automaton(terms)
+
+    tables = {'kanji': 'kanjis', 'reading': 'readings', 'gloss': 'glosses'}
+
+    seen = set()
+    for field in fields:
+        sql = 'SELECT ent_seq, %s FROM %s' % (field, tables[field])
+        if frequent:
+            sql += ' WHERE frequent = 1'
+        database.execute(cur, sql + ';')
+
+        for ent_seq, text in cur:
+            if not case_sensitive:
+                text = text.lower()
+            for term in automaton.search(text):
+                if case_sensitive:
+                    found = (term,)
+                else:
+                    found = originals[term]
+                for term in found:
+                    if (term, ent_seq) not in seen:
+                        seen.add((term, ent_seq))
+                        yield (term, ent_seq)
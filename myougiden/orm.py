@@ -1,23 +1,113 @@
+import json
+import struct
+import sys
+
 from myougiden import config
 from myougiden import search
 from myougiden import color
 from myougiden import database
 from myougiden.color import fmt
 
+# JMdict <sense> elements whose contents are abbreviations (entities).  They
+# are stored in table sense_tags, and are attributes of Sense.
+sense_tag_kinds = ('pos', 'field', 'misc', 'dial')
+
+class FormatContext():
+    '''Formatting state for one query.
+
+    Built once from the SearchConditions chosen by search.guess(), and passed
+    to every formatter.  It holds the compiled match regexp, the separators
+    (already colored), and the escape codes for each style, so that
+    formatting an entry doesn't redo any of this work.
+
+    Must be created after myougiden.color is set up.'''
+
+    def __init__(self, search_conds=None, romaji=None):
+        '''romaji is None, 'hepburn' or 'kunrei' (to output readings in
+        rōmaji).'''
+
+        self.romaji = romaji
+
+        if search_conds:
+            self.field = search_conds.field
+            self.matchreg = search.matched_regexp(search_conds,
+                                                  romaji_output=bool(romaji))
+        else:
+            self.field = None
+            self.matchreg = None
+
+        self.use_color = color.use_color
+        self.codes = {sty: color.style_codes(sty) for sty in color.style}
+
+        # as of 2012-02-22, no kanji or reading field uses full-width
+        # semicolon.
+        self.ksep = self.fmt('；', 'subdue')
+
+        self.rsep_tsv = self.fmt('；', 'subdue')
+        # ascii comma is free, too
+        self.rsep_tsv_romaji = self.fmt(',', 'subdue')
+        # as of 2012-02-22, only one entry uses '|' .
+        # and it's "c|net", which should be "CNET" anyway.
+        self.gsep_tsv = self.fmt('|', 'subdue')
+        self.frequent_tsv = self.fmt('(P)', 'highlight')
+
+        self.rsep_human = self.fmt('、', 'subdue')
+        self.rsep_human_romaji = self.fmt(', ', 'subdue')
+        self.gsep_human = self.fmt('; ', 'subdue')
+        self.rpar = (self.fmt('（', 'subdue')
+                     + '%s'
+                     + self.fmt('）', 'subdue'))
+        self.frequent_human = self.fmt('※', 'highlight')
+
+        self.nokanji = self.fmt('＊', 'subdue')
+
+    def fmt(self, string, sty):
+        '''Like myougiden.color.fmt(), with cached escape codes.'''
+        start, end = self.codes[sty]
+        return start + string + end
+
+    def color_match(self, longstring, base_style=None, match_style='match'):
+        '''Like myougiden.color.color_regexp(), with the query regexp.'''
+
+        if not self.use_color:
+            return longstring
+
+        m = self.matchreg.search(longstring)
+        if not m:
+            if base_style:
+                return self.fmt(longstring, base_style)
+            else:
+                return longstring
+        else:
+            head = longstring[:m.start()]
+            tail = longstring[m.end():]
+            if base_style:
+                head = self.fmt(head, base_style)
+                tail = self.fmt(tail, base_style)
+            return head + self.fmt(m.group(), match_style) + tail
+
 class Entry():
     '''Equivalent to JMdict entry.'''
+
+    # tens of thousands of these may be alive at once (wide partial searches,
+    # updatedb buffers), so we skip the per-instance __dict__.
+    __slots__ = ('ent_seq', 'kanjis', 'readings', 'senses', 'frequent',
+                 'freq_rank')
+
     def __init__(self,
                  ent_seq=None, # JMdict ID
                  frequent=False, # similar to EDICT (P)
                  kanjis=None, # list of Kanjis()
                  readings=None, # list of Readings()
                  senses=None, # list of Senses
+                 freq_rank=None, # lower is more frequent
                 ):
         self.ent_seq = ent_seq
         self.kanjis = kanjis or []
         self.readings = readings or []
         self.senses = senses or []
         self.frequent = frequent
+        self.freq_rank = freq_rank
 
     def is_frequent(self):
         # TODO: more fine-grained
@@ -25,71 +115,41 @@ class Entry():
 
 
     # this thing really needs to be better thought of
-    def format_tsv(self, search_conds, romajifn=None):
-        matchreg = search.matched_regexp(search_conds)
-
-        # as of 2012-02-22, no kanji or reading field uses full-width
-        # semicolon.
-        ksep = fmt('；', 'subdue')
-
-        if romajifn:
-            # ascii comma is free, too
-            rsep = fmt(',', 'subdue')
-            for r in self.readings:
-                r.romaji = romajifn
-        else:
-            rsep = fmt('；', 'subdue')
-
-        # as of 2012-02-22, only one entry uses '|' .
-        # and it's "c|net", which should be "CNET" anyway.
-        gsep = fmt('|', 'subdue')
-
-        # escape separator
-        for sense in self.senses:
-            for idx, gloss in enumerate(sense.glosses):
-                # I am unreasonably proud of this solution.
-                sense.glosses[idx] = sense.glosses[idx].replace(gsep, '¦')
-
-
+    def format_tsv(self, ctx):
         s = ''
 
-        s += rsep.join([r.fmt(search_conds)
-                        for r in self.readings])
-        s += "\t" + ksep.join([k.fmt(search_conds)
-                               for k in self.kanjis])
+        if ctx.romaji:
+            s += ctx.rsep_tsv_romaji.join([r.fmt(ctx) for r in self.readings])
+        else:
+            s += ctx.rsep_tsv.join([r.fmt(ctx) for r in self.readings])
+        s += "\t" + ctx.ksep.join([k.fmt(ctx) for k in self.kanjis])
 
         for sense in self.senses:
-            tagstr = sense.tagstr(search_conds)
+            tagstr = sense.tagstr(ctx)
             if tagstr: tagstr += ' '
 
-            s += "\t%s%s" % (tagstr, gsep.join(sense.glosses))
+            # escape separator.  I am unreasonably proud of this solution.
+            s += "\t%s%s" % (tagstr,
+                             ctx.gsep_tsv.join([gloss.replace('|', '¦')
+                                                for gloss in sense.glosses]))
 
         if self.is_frequent():
-            s += ' ' + fmt('(P)', 'highlight')
+            s += ' ' + ctx.frequent_tsv
 
         return s
 
-    def format_human(self, search_conds, romajifn=None):
-        matchreg = search.matched_regexp(search_conds)
-
-        ksep = fmt('；', 'subdue')
-
-        if romajifn:
-            rsep = fmt(', ', 'subdue')
-            for r in self.readings:
-                r.romaji = romajifn
+    def format_human(self, ctx):
+        if ctx.romaji:
+            rsep = ctx.rsep_human_romaji
         else:
-            rsep = fmt('、', 'subdue')
-
-        gsep = fmt('; ', 'subdue')
-        rpar = (fmt('（', 'subdue')
-                + '%s'
-                + fmt('）', 'subdue'))
+            rsep = ctx.rsep_human
+        ksep = ctx.ksep
+        rpar = ctx.rpar
 
         s = ''
 
         if self.is_frequent():
-            s += fmt('※', 'highlight') + ' '
+            s += ctx.frequent_human + ' '
 
 
         has_re_restr = False
@@ -100,33 +160,66 @@ class Entry():
 
         if self.kanjis:
             if not has_re_restr:
-                s += ksep.join([k.fmt(search_conds) for k in self.kanjis])
-                s += rpar % (rsep.join([r.fmt(search_conds) for r in self.readings]))
+                s += ksep.join([k.fmt(ctx) for k in self.kanjis])
+                s += rpar % (rsep.join([r.fmt(ctx) for r in self.readings]))
             else:
                 ks = []
                 for k in self.kanjis:
-                    my_r = [r.fmt(search_conds) for r in self.readings
+                    my_r = [r.fmt(ctx) for r in self.readings
                             if not r.re_restr or k.text in r.re_restr]
-                    ks.append(k.fmt(search_conds)
+                    ks.append(k.fmt(ctx)
                               + rpar % (rsep.join(my_r)))
                 s += ksep.join(ks)
         else:
-            s += rsep.join([r.fmt(search_conds) for r in self.readings])
+            s += rsep.join([r.fmt(ctx) for r in self.readings])
 
 
         for sensenum, sense in enumerate(self.senses, start=1):
-            sn = fmt('%d.' % sensenum, 'misc')
+            sn = ctx.fmt('%d.' % sensenum, 'misc')
 
-            tagstr = sense.tagstr(search_conds)
+            tagstr = sense.tagstr(ctx)
             if tagstr: tagstr += ' '
 
             s += "\n%s %s%s" % (sn,
                                 tagstr,
-                                gsep.join(sense.fmt_glosses(search_conds)))
+                                ctx.gsep_human.join(sense.fmt_glosses(ctx)))
         return s
 
+    def to_dict(self):
+        '''Return entry as a dict of plain values (for serialization).'''
+
+        return {
+            'ent_seq': self.ent_seq,
+            'frequent': bool(self.frequent),
+            'freq_rank': self.freq_rank,
+            'kanjis': [k.to_dict() for k in self.kanjis],
+            'readings': [r.to_dict() for r in self.readings],
+            'senses': [sense.to_dict() for sense in self.senses],
+        }
+
+    def format_json(self):
+        '''Return entry as a single line of JSON.
+
+        Doesn't go through fmt(); output is never colored.'''
+
+        return json.dumps(self.to_dict(), ensure_ascii=False,
+                          separators=(',', ':'))
+
+    def format_binary(self):
+        '''Return entry as UTF-8 JSON bytes, prefixed by their length.
+
+        The length is a 4-byte, big-endian unsigned integer, so that
+        consumers can split a stream of records without scanning for
+        newlines.'''
+
+        data = self.format_json().encode('utf-8')
+        return struct.pack('>I', len(data)) + data
+
 class Kanji():
     '''Equivalent to JMdict <k_ele>.'''
+
+    __slots__ = ('kanji_id', 'text', 'frequent', 'ke_inf')
+
     def __init__(self,
                  kanji_id=None,
                  text=None, # = keb
@@ -137,100 +230,123 @@ class Kanji():
         self.frequent = frequent
         self.ke_inf = ke_inf
 
-    def fmt(self, search_conds=None):
-        if search_conds and search_conds.field == 'kanji':
-            matchreg = search.matched_regexp(search_conds)
-            t = color.color_regexp(matchreg,
-                                      self.text,
-                                      'kanji',
-                                      'matchjp')
+    def fmt(self, ctx=None):
+        if ctx is None:
+            ctx = FormatContext()
+
+        if ctx.field == 'kanji':
+            t = ctx.color_match(self.text, 'kanji', 'matchjp')
         else:
-            t = fmt(self.text, 'kanji')
+            t = ctx.fmt(self.text, 'kanji')
 
         if self.ke_inf:
-            t = t + fmt('[' + self.ke_inf + ']', 'subdue')
+            t = t + ctx.fmt('[' + self.ke_inf + ']', 'subdue')
         return t
 
+    def to_dict(self):
+        return {
+            'text': self.text,
+            'frequent': bool(self.frequent),
+            'ke_inf': self.ke_inf,
+        }
+
 
 class Reading():
     '''Equivalent to JMdict <r_ele>.'''
+
+    __slots__ = ('reading_id', 'text', 'hepburn', 'kunrei', 're_nokanji',
+                 're_restr', 're_inf', 'frequent')
+
     def __init__(self,
                  reading_id=None,
                  text=None, # = reb
+                 hepburn=None,
+                 kunrei=None,
                  re_nokanji=False,
-                 re_restr=None,
+                 re_restr=(), # tuple of kanji strings
                  re_inf=None,
                  frequent=False,
-
-                 # None or a function
-                 romaji=None,
                 ):
         self.reading_id = reading_id
         self.text = text
+        self.hepburn = hepburn
+        self.kunrei = kunrei
         self.re_nokanji = re_nokanji
-        self.re_restr = re_restr or []
+        self.re_restr = re_restr
         self.re_inf = re_inf
         self.frequent = frequent
-        self.romaji = romaji
 
-    def fmt(self, search_conds=None):
-        if self.romaji:
-            t = self.romaji(self.text)
+    def fmt(self, ctx=None):
+        if ctx is None:
+            ctx = FormatContext()
+
+        if ctx.romaji:
+            t = getattr(self, ctx.romaji)
         else:
             t = self.text
 
-        if search_conds and search_conds.field == 'reading':
-            matchreg = search.matched_regexp(search_conds)
-            t = color.color_regexp(matchreg,
-                                      t,
-                                      'reading',
-                                      'matchjp')
+        if ctx.field == 'reading':
+            t = ctx.color_match(t, 'reading', 'matchjp')
         else:
-            t = fmt(t, 'reading')
+            t = ctx.fmt(t, 'reading')
 
         if self.re_nokanji:
-            t = fmt('＊', 'subdue') + t
+            t = ctx.nokanji + t
         if self.re_inf:
-            t = t + fmt('[' + self.re_inf + ']', 'subdue')
+            t = t + ctx.fmt('[' + self.re_inf + ']', 'subdue')
         return t
 
+    def to_dict(self):
+        return {
+            'text': self.text,
+            'hepburn': self.hepburn,
+            'kunrei': self.kunrei,
+            'frequent': bool(self.frequent),
+            're_nokanji': bool(self.re_nokanji),
+            're_restr': list(self.re_restr),
+            're_inf': self.re_inf,
+        }
+
 
 class Sense():
     '''Equivalent to JMdict <sense>.
 
     Attributes:
     - sense_id: database ID.
-    - glosses: a list of glosses (as strings).
+    - glosses: a tuple of glosses (as strings).
     '''
 
+    __slots__ = ('sense_id', 'glosses', 'stagk', 'stagr',
+                 'pos', 'field', 'misc', 'dial', 's_inf')
+
     def __init__(self,
                  sense_id=None,
 
-                 # glosses, a list of strings
-                 glosses=None,
+                 # glosses, a tuple of strings
+                 glosses=(),
 
-                 # restrictions, as lists of strings
-                 stagk=None,
-                 stagr=None,
+                 # restrictions, as tuples of strings
+                 stagk=(),
+                 stagr=(),
 
-                 # each is a string of abbreviations separated by ';'
-                 pos=None,
-                 field=None,
-                 misc=None,
-                 s_inf=None,
+                 # each is a tuple of abbreviations
+                 pos=(),
+                 field=(),
+                 misc=(),
+                 dial=(),
 
                  # arbitrary string
-                 dial=None,
+                 s_inf=None,
 
                  # TODO
                  # lsource=None,
                 ):
         self.sense_id = sense_id
 
-        self.glosses = glosses or list()
+        self.glosses = glosses
 
-        self.stagk = stagk or list()
-        self.stagr = stagr or list()
+        self.stagk = stagk
+        self.stagr = stagr
 
         self.pos = pos
         self.field = field
@@ -240,17 +356,17 @@ class Sense():
         self.s_inf = s_inf
 
 
-    def tagstr(self, search_conditions):
+    def tagstr(self, ctx=None):
         '''Return a string with all information tags.
 
         Automatic colors depending on myougiden.color.use_color .'''
 
         tagstr = ''
         tags = []
-        for attr in ('pos', 'field', 'misc', 'dial'):
+        for attr in sense_tag_kinds:
             tag = getattr(self, attr)
             if tag:
-                tags.append(tag)
+                tags.append(','.join(tag))
         if len(tags) > 0:
             tagstr += '[%s]' % (';'.join(tags))
 
@@ -265,127 +381,245 @@ class Sense():
             tagstr += '〔%s〕' % '、'.join(self.stagk + self.stagr)
 
         if len(tagstr) > 0:
-            return fmt(tagstr, 'subdue')
+            if ctx is None:
+                return fmt(tagstr, 'subdue')
+            return ctx.fmt(tagstr, 'subdue')
         else:
             return ''
 
-    def fmt_glosses(self, search_conds=None):
+    def fmt_glosses(self, ctx=None):
         '''Return list of formatted strings, one per gloss.'''
 
-        if search_conds and search_conds.field == 'gloss':
-            matchreg = search.matched_regexp(search_conds)
-            return [color.color_regexp(matchreg,
-                                       gloss)
-                   for gloss in self.glosses]
+        if ctx and ctx.field == 'gloss':
+            return [ctx.color_match(gloss) for gloss in self.glosses]
         else:
-            return [gloss for gloss in self.glosses]
+            return list(self.glosses)
+
+    def to_dict(self):
+        d = {'glosses': list(self.glosses)}
+        for attr in sense_tag_kinds + ('stagk', 'stagr'):
+            d[attr] = list(getattr(self, attr))
+        d['s_inf'] = self.s_inf
+        return d
 
 
+def intern_tag(tag):
+    '''Return a shared copy of tag string (or None).
+
+    Tags come from a small vocabulary (the abbreviations table), so each
+    distinct string is only kept once, no matter how many senses use it.'''
+
+    if tag is None:
+        return None
+    return sys.intern(tag)
+
+# database generation -> {abbrev_id: abbrev}; see load_abbrevs()
+abbrevs_by_generation = {}
+
+def load_abbrevs(cur):
+    '''Return dict of abbrev_id -> abbrev, reading it from database once
+    per generation (see database.publish()).'''
+
+    generation = getattr(cur.connection, 'generation', None)
+    abbrevs = abbrevs_by_generation.get(generation)
+    if abbrevs is None:
+        database.execute(cur, 'SELECT abbrev_id, abbrev FROM abbreviations;')
+        abbrevs = {row[0]: intern_tag(row[1]) for row in cur.fetchall()}
+        # older generations are only read while readers switch over
+        abbrevs_by_generation.clear()
+        abbrevs_by_generation[generation] = abbrevs
+    return abbrevs
+
 def fetch_entry(cur, ent_seq):
     '''Return Entry object..'''
 
-    kanjis = []
-    readings = []
-    senses = []
+    return fetch_entries(cur, [ent_seq])[0]
+
+# sqlite limits the number of '?' parameters in a statement (999 in older
+# versions).
+fetch_batch_size = 500
+
+def fetch_entries(cur, ent_seqs):
+    '''Return list of Entry objects, in the same order as ent_seqs.
+
+    Each table is read with a single query for the whole batch, instead of
+    a few queries per entry; ent_seqs should have at most fetch_batch_size
+    items.'''
+
+    abbrevs = load_abbrevs(cur)
+    marks = ','.join('?' * len(ent_seqs))
+    ent_seqs = list(ent_seqs)
+
+    entries = {}
+    database.execute(cur, '''SELECT ent_seq, frequent, freq_rank
+                FROM entries
+                WHERE ent_seq IN (%s);''' % marks, ent_seqs)
+    for row in cur.fetchall():
+        entries[row[0]] = Entry(ent_seq=row[0],
+                                frequent=row[1],
+                                freq_rank=row[2])
 
     database.execute(cur, '''SELECT
+                ent_seq,
                 kanji_id,
                 kanji,
                 ke_inf,
                 frequent
                 FROM kanjis
-                WHERE ent_seq = ?;''', [ent_seq])
+                WHERE ent_seq IN (%s)
+                ORDER BY kanji_id;''' % marks, ent_seqs)
     for row in cur.fetchall():
-        kanjis.append(Kanji(
-            kanji_id=row[0],
-            text=row[1],
-            ke_inf=row[2],
-            frequent=row[3],
+        entries[row[0]].kanjis.append(Kanji(
+            kanji_id=row[1],
+            text=row[2],
+            ke_inf=intern_tag(row[3]),
+            frequent=row[4],
         ))
 
+    # reading_id -> list of re_restr
+    restrs = {}
     database.execute(cur, '''SELECT
+                reading_restrictions.reading_id,
+                re_restr
+                FROM reading_restrictions
+                JOIN readings
+                  ON readings.reading_id = reading_restrictions.reading_id
+                WHERE ent_seq IN (%s)
+                ORDER BY restr_id;''' % marks, ent_seqs)
+    for row in cur.fetchall():
+        restrs.setdefault(row[0], []).append(row[1])
+
+    database.execute(cur, '''SELECT
+                ent_seq,
                 reading_id,
                 reading,
+                hepburn,
+                kunrei,
                 re_nokanji,
                 frequent,
                 re_inf
                 FROM readings
-                WHERE ent_seq = ?;''', [ent_seq])
+                WHERE ent_seq IN (%s)
+                ORDER BY reading_id;''' % marks, ent_seqs)
+    for row in cur.fetchall():
+        entries[row[0]].readings.append(Reading(
+            reading_id=row[1],
+            text=row[2],
+            hepburn=row[3],
+            kunrei=row[4],
+            re_nokanji=row[5],
+            frequent=row[6],
+            re_inf=intern_tag(row[7]),
+            re_restr=tuple(restrs.get(row[1], ())),
+        ))
+
+    # sense_id -> kind -> list of abbrevs
+    tags = {}
+    database.execute(cur, '''SELECT
+                sense_id,
+                kind,
+                abbrev_id
+                FROM sense_tags
+                WHERE ent_seq IN (%s)
+                ORDER BY rowid;''' % marks, ent_seqs)
+    for row in cur.fetchall():
+        tags.setdefault(row[0], {}).setdefault(row[1], []).append(abbrevs[row[2]])
+
+    # sense_id -> list of stagk, stagr
+    stagks = {}
+    database.execute(cur, '''SELECT
+                sense_kanji_restrictions.sense_id,
+                stagk
+                FROM sense_kanji_restrictions
+                JOIN senses
+                  ON senses.sense_id = sense_kanji_restrictions.sense_id
+                WHERE ent_seq IN (%s)
+                ORDER BY stagk_id;''' % marks, ent_seqs)
+    for row in cur.fetchall():
+        stagks.setdefault(row[0], []).append(row[1])
 
+    stagrs = {}
+    database.execute(cur, '''SELECT
+                sense_reading_restrictions.sense_id,
+                stagr
+                FROM sense_reading_restrictions
+                JOIN senses
+                  ON senses.sense_id = sense_reading_restrictions.sense_id
+                WHERE ent_seq IN (%s)
+                ORDER BY stagr_id;''' % marks, ent_seqs)
     for row in cur.fetchall():
-        reading = Reading(
-            reading_id=row[0],
-            text=row[1],
-            re_nokanji=row[2],
-            frequent=row[3],
-            re_inf=row[4],
-        )
-
-        database.execute(cur, '''SELECT re_restr
-                    FROM reading_restrictions
-                    WHERE reading_id = ?;''',
-                    [reading.reading_id])
-        for row in cur.fetchall():
-            reading.re_restr.append(row[0])
-
-        readings.append(reading)
-
-
-    senses = []
-    database.execute(cur, 
+        stagrs.setdefault(row[0], []).append(row[1])
+
+    # sense_id -> list of glosses
+    glosses = {}
+    database.execute(cur, '''SELECT sense_id, gloss
+                FROM glosses
+                WHERE sense_id IN (SELECT sense_id
+                                   FROM senses
+                                   WHERE ent_seq IN (%s))
+                ORDER BY gloss_id;''' % marks, ent_seqs)
+    for row in cur.fetchall():
+        glosses.setdefault(row[0], []).append(row[1])
+
+    database.execute(cur,
         '''SELECT
+        ent_seq,
         sense_id,
-        pos,
-        field,
-        misc,
-        dial,
         s_inf
         FROM senses
-        WHERE ent_seq = ?;''',
-        [ent_seq]
+        WHERE ent_seq IN (%s)
+        ORDER BY sense_id;''' % marks,
+        ent_seqs
     )
-
     for row in cur.fetchall():
-        sense = Sense(sense_id=row[0],
-                      pos=row[1],
-                      field=row[2],
-                      misc=row[3],
-                      dial=row[4],
-                      s_inf=row[5])
-
-        database.execute(cur, '''
-                    SELECT stagk
-                    FROM sense_kanji_restrictions
-                    WHERE sense_id = ?;
-                    ''', [sense.sense_id]
-                   )
-        for row in cur.fetchall():
-            sense.stagk.append(row[0])
-
-        database.execute(cur, '''
-                    SELECT stagr
-                    FROM sense_reading_restrictions
-                    WHERE sense_id = ?;
-                    ''', [sense.sense_id]
-                   )
-        for row in cur.fetchall():
-            sense.stagr.append(row[0])
-
-        database.execute(cur, 'SELECT gloss FROM glosses WHERE sense_id = ?;', [sense.sense_id])
-        for row in cur.fetchall():
-            sense.glosses.append(row[0])
-
-        senses.append(sense)
-
-    database.execute(cur, 'SELECT frequent FROM entries WHERE ent_seq = ?;', [ent_seq])
-    frequent=cur.fetchone()[0]
-
-    return Entry(ent_seq=ent_seq,
-                 frequent=frequent,
-                 kanjis=kanjis,
-                 readings=readings,
-                 senses=senses,
-                )
+        sense_id = row[1]
+        sense_tags = tags.get(sense_id, {})
+        entries[row[0]].senses.append(Sense(
+            sense_id=sense_id,
+            glosses=tuple(glosses.get(sense_id, ())),
+            stagk=tuple(stagks.get(sense_id, ())),
+            stagr=tuple(stagrs.get(sense_id, ())),
+            pos=tuple(sense_tags.get('pos', ())),
+            field=tuple(sense_tags.get('field', ())),
+            misc=tuple(sense_tags.get('misc', ())),
+            dial=tuple(sense_tags.get('dial', ())),
+            s_inf=row[2],
+        ))
+
+    return [entries[ent_seq] for ent_seq in ent_seqs]
+
+def iter_entries(cur, frequent=False, tags=(), batch_size=fetch_batch_size):
+    '''Yield every Entry in the database (optionally filtered), by ent_seq.
+
+    tags are as returned by search.tag_filters().
+
+    ent_seqs are read incrementally from a separate cursor, and entries are
+    built batch_size at a time, so memory use doesn't grow with the size
+    of the dictionary.'''
+
+    where = []
+    params = []
+    if frequent:
+        where.append('frequent = 1')
+    if tags:
+        tags_sql, tags_params = search.tags_where(tags)
+        where.append(tags_sql)
+        params += tags_params
+
+    sql = 'SELECT ent_seq FROM entries'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY ent_seq;'
+
+    seq_cur = cur.connection.cursor()
+    database.execute(seq_cur, sql, params)
+    while True:
+        rows = seq_cur.fetchmany(batch_size)
+        if not rows:
+            break
+        for entry in fetch_entries(cur, [row[0] for row in rows]):
+            yield entry
+    seq_cur.close()
 
 def short_expansion(cur, abbrev):
     database.execute(cur, ''' SELECT short_expansion FROM abbreviations WHERE abbrev = ? ;''', [abbrev])
@@ -0,0 +1,140 @@
+'''Planning of guess() searches.
+
+guess() tries SearchConditions in a fixed order, and stops at the first
+with results; on a miss, that's every tier, partial (LIKE) scans included.
+The planner uses statistics computed by updatedb-myougiden to skip
+conditions that provably can't match, and to estimate the cost of the
+others:
+
+- field_chars: for each column, the characters occurring in it, with the
+  number of rows having each.
+- field_lengths: for each column, the number of rows of each length.
+- field_bigrams: for each column, the bigrams occurring in it.
+
+Columns are those of SearchConditions.column(); all statistics are of
+ASCII case-folded text (like LIKE and COLLATE NOCASE), so they hold for
+case-sensitive searches too.
+
+Only 'whole' and 'partial' conditions, without regexps, are checked: their
+query is a literal string.  FTS and REGEXP queries have a syntax of their
+own.
+'''
+
+from myougiden import database
+
+# database generation -> column -> dict; see load_stats()
+stats = {}
+
+fold_table = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ',
+                           'abcdefghijklmnopqrstuvwxyz')
+
+def fold(string):
+    '''Fold ASCII case, like sqlite's LIKE and NOCASE.'''
+    return string.translate(fold_table)
+
+def bigrams(string):
+    return set(string[i:i+2] for i in range(len(string) - 1))
+
+def load_stats(cur):
+    '''Return dict of column -> {'chars': {char: rows}, 'lengths': {length:
+    rows}, 'rows': rows}, reading it from database once per generation (see
+    database.publish()).'''
+
+    generation = getattr(cur.connection, 'generation', None)
+    columns = stats.get(generation)
+    if columns is None:
+        columns = {}
+        database.execute(cur, 'SELECT field, char, count FROM field_chars;')
+        for field, char, count in cur.fetchall():
+            columns.setdefault(field, {'chars': {}, 'lengths': {}, 'rows': 0})
+            columns[field]['chars'][char] = count
+
+        database.execute(cur, 'SELECT field, length, count FROM field_lengths;')
+        for field, length, count in cur.fetchall():
+            columns.setdefault(field, {'chars': {}, 'lengths': {}, 'rows': 0})
+            columns[field]['lengths'][length] = count
+            columns[field]['rows'] += count
+
+        # older generations are only read while readers switch over
+        stats.clear()
+        stats[generation] = columns
+    return columns
+
+def checkable(cond):
+    return (not cond.regexp
+            and cond.extent in ('whole', 'partial')
+            and '\\' not in cond.query_s)
+
+def possible(cur, cond):
+    '''False if search_by(cur, cond) certainly returns nothing.
+
+    Checks characters and length of the query against the column
+    statistics (in memory); for 'partial', also checks its bigrams (one
+    index lookup).'''
+
+    if not checkable(cond):
+        return True
+
+    column = load_stats(cur).get(cond.column())
+    if column is None:
+        return True
+
+    query = fold(cond.query_s)
+    if not all(char in column['chars'] for char in query):
+        return False
+
+    if cond.extent == 'whole':
+        return len(query) in column['lengths']
+
+    if len(query) > max(column['lengths'], default=0):
+        return False
+
+    grams = bigrams(query)
+    if grams:
+        database.execute(cur, '''
+SELECT count(*)
+FROM field_bigrams
+WHERE field = ? AND gram IN (%s)
+;''' % ','.join('?' * len(grams)), [cond.column()] + list(grams))
+        if cur.fetchone()[0] < len(grams):
+            return False
+
+    return True
+
+def cost(cur, cond):
+    '''Estimated number of rows search_by(cur, cond) will examine.
+
+    Index lookups count as 1; table scans as the number of rows in the
+    table, except for partial kanji searches, which only look at the kebs
+    having the rarest character of the query (see
+    search.kanji_chars_where()).'''
+
+    column = load_stats(cur).get(cond.column())
+    if column is None:
+        return 1
+
+    if cond.regexp:
+        return column['rows']
+    elif cond.extent == 'partial':
+        if cond.field == 'kanji':
+            query = fold(cond.query_s)
+            counts = [column['chars'].get(char, 0) for char in query
+                      if ord(char) >= 128]
+            if counts:
+                return min(counts)
+        return column['rows']
+    else:
+        return 1
+
+# conditions examining fewer rows than this (according to cost()) are
+# cheap enough to run right away, without a dedicated scan slot or
+# speculation.
+small_scan_rows = 10000
+
+def plan(cur, conditions):
+    '''Return list of (condition, cost) for conditions that may match, in
+    the order guess() should try them.'''
+
+    conditions = sorted(conditions, key=lambda cond: cond.sort_key())
+    return [(cond, cost(cur, cond)) for cond in conditions
+            if possible(cur, cond)]
@@ -1,9 +1,14 @@
+import argparse
 import re
 import romkan
 from myougiden import common
 from myougiden import database
+from myougiden import deinflect
+from myougiden import fuzzy
+from myougiden import orm
+from myougiden import planner
 from myougiden import texttools as tt
-from copy import deepcopy
+from copy import copy
 
 class SearchConditions():
     '''A set of conditions to query the dictionary.
@@ -19,21 +24,41 @@ class SearchConditions():
                  regexp,
                  field,
                  extent,
+                 romaji=False,
                 ):
         self.regexp = regexp
         self.field = field
         self.extent = extent
 
+        # if True, query is rōmaji, to be matched against the 'hepburn'
+        # column of readings.
+        self.romaji = romaji
+
         self.query = query
         self.query_s = ' '.join(query)
         self.case_sensitive = cmdline_args.case_sensitive
         self.frequent = cmdline_args.frequent
+        self.tags = tag_filters(cmdline_args)
+
+        # pagination of results; see search_by()
+        self.limit = getattr(cmdline_args, 'limit', None)
+        self.offset = getattr(cmdline_args, 'offset', 0) or 0
+
+        # limits on each search (see budget()), and whether guess() should
+        # go on to the next condition when they're exceeded.
+        self.timeout = getattr(cmdline_args, 'timeout', None)
+        self.max_steps = getattr(cmdline_args, 'max_steps', None)
+        self.skip_timeouts = getattr(cmdline_args, 'skip_timeouts', False)
+
+        # set by guess() to the QueryTimeout message, if skipped
+        self.timed_out = None
 
         self.args = cmdline_args
 
 
     def extent_sort_key(self):
-        return ['whole','word','beginning','partial'].index(self.extent)
+        return ['whole','word','beginning','inflected','partial',
+                'fuzzy'].index(self.extent)
 
     def field_sort_key(self):
         if tt.is_kana(self.args.query_s):
@@ -62,18 +87,251 @@ class SearchConditions():
 
         # basically we try all extents before trying other fields.
         # however, 'partial' extents are a last resort, so they are only tried
-        # separatedly, after trying all fields.
+        # separatedly, after trying all fields.  deinflection comes just
+        # before them.  fuzzy matching is tried only when everything else,
+        # regexps included, found nothing.
+        if self.extent == 'fuzzy':
+            regexp_key = 3
+
         if self.extent == 'partial':
+            partial_key = 3
+        elif self.extent == 'inflected':
             partial_key = 2
         else:
             partial_key = 1
 
         return [regexp_key, partial_key, field_key, extent_key]
 
+    def is_scan(self):
+        '''True if search_by() will have to scan a whole table.
+
+        Regexps and partial matches can't use any index; they are much
+        slower than other searches.'''
+
+        return self.regexp or self.extent == 'partial'
+
+    def budget(self, cancelled=None):
+        '''Return database.Budget for searching this condition, or None
+        if there are no limits.'''
+
+        if self.timeout is None and self.max_steps is None and not cancelled:
+            return None
+        return database.Budget(self.timeout, self.max_steps, cancelled)
+
+    def column(self):
+        '''Database column to search.'''
+        if self.romaji:
+            return 'hepburn'
+        else:
+            return self.field
+
     def __repr__(self):
-        return("'%s': regexp %s, field %s, extent %s\n sort key: %s" %
+        return("'%s': regexp %s, field %s, extent %s, romaji %s\n sort key: %s" %
               (list(self.query), self.regexp, self.field, self.extent,
-               self.sort_key()))
+               self.romaji, self.sort_key()))
+
+# "\" seems to be the least common character in EDICT.
+like_operator = r"LIKE ? ESCAPE '\'"
+
+def like_escape(string):
+    '''Escape string for use in a LIKE pattern (see like_operator).'''
+
+    # my editor doesn't like raw strings
+    # string = string.replace(r'\', r'\\')
+    string = string.replace('\\', '\\\\')
+
+    string = string.replace('%', r'\%')
+    string = string.replace('_', r'\_')
+    return string
+
+def make_args(query,
+              field='auto',
+              extent='auto',
+              regexp=False,
+              case_sensitive=None,
+              frequent=False,
+              tags=(),
+              limit=None,
+              offset=0,
+              timeout=None,
+              max_steps=None,
+              skip_timeouts=False):
+    '''Return an object with the same attributes as command-line args.
+
+    For library use of generate_search_conditions() and friends.  query is
+    a string or a list of strings (like argv); tags is a list of (kind,
+    abbrev) pairs, as returned by tag_filters().  If case_sensitive is None,
+    it is guessed from the query, like the command line does.  timeout and
+    max_steps limit each search (see SearchConditions.budget()).'''
+
+    if isinstance(query, str):
+        query = [query]
+
+    args = argparse.Namespace(query=list(query),
+                              query_s=' '.join(query),
+                              field=field,
+                              extent=extent,
+                              regexp=regexp,
+                              case_sensitive=case_sensitive,
+                              frequent=frequent,
+                              limit=limit,
+                              offset=offset,
+                              timeout=timeout,
+                              max_steps=max_steps,
+                              skip_timeouts=skip_timeouts)
+
+    if args.case_sensitive is None:
+        args.case_sensitive = bool(re.search('[A-Z]', args.query_s))
+
+    for kind in orm.sense_tag_kinds:
+        setattr(args, kind + '_tags',
+                [abbrev for k, abbrev in tags if k == kind])
+
+    return args
+
+def tag_filters(args):
+    '''Return list of (kind, abbrev) sense tags required by args.
+
+    args = command-line argument dict (argparse object), with attributes
+    pos_tags, field_tags etc. (see orm.sense_tag_kinds).'''
+
+    tags = []
+    for kind in orm.sense_tag_kinds:
+        for abbrev in getattr(args, kind + '_tags', None) or ():
+            tags.append((kind, abbrev))
+    return tags
+
+def tags_where(tags):
+    '''Return (sql, params) restricting ent_seq to entries having all tags.
+
+    tags is a list of (kind, abbrev), as returned by tag_filters().  Each tag
+    is an index lookup in sense_tags.'''
+
+    clauses = []
+    params = []
+    for kind, abbrev in tags:
+        clauses.append('''ent_seq IN (
+          SELECT ent_seq FROM sense_tags
+          WHERE abbrev_id = (SELECT abbrev_id FROM abbreviations WHERE abbrev = ?)
+            AND kind = ?)''')
+        params += [abbrev, kind]
+    return ' AND '.join(clauses), params
+
+def limit_sql(limit, offset):
+    '''Return (sql, params) of a LIMIT clause; limit may be None.'''
+
+    if limit is not None:
+        return 'LIMIT ? OFFSET ?', [limit, offset]
+    elif offset:
+        return 'LIMIT -1 OFFSET ?', [offset]
+    else:
+        return '', []
+
+def gloss_words_where(words):
+    '''Return (sql, params) restricting gloss_id to glosses having all words.
+
+    words is a list of whole words, as returned by texttools.words().
+    Matching is case-sensitive, and uses the gloss_words index.'''
+
+    if not words:
+        return '', []
+
+    subqueries = ['SELECT gloss_id FROM gloss_words WHERE word = ?']
+    subqueries *= len(set(words))
+    return ('gloss_id IN (%s)' % ' INTERSECT '.join(subqueries),
+            list(set(words)))
+
+def kanji_chars_where(string):
+    '''Return (sql, params) restricting ent_seq to entries whose kebs have
+    all the characters in string.
+
+    Uses the kanji_chars index.  ASCII characters are skipped, since LIKE
+    may fold their case.'''
+
+    chars = sorted(set(c for c in string if ord(c) > 127 and not c.isspace()))
+    if not chars:
+        return '', []
+
+    subqueries = ['SELECT ent_seq FROM kanji_chars WHERE char = ?'] * len(chars)
+    return ('ent_seq IN (%s)' % ' INTERSECT '.join(subqueries), chars)
+
+def search_by_tags(cur, tags, frequent=False, limit=None, offset=0):
+    '''Return list of ent_seqs having all tags (see tags_where()).
+
+    Used when there are tag filters but no query.  Results are ordered by
+    frequency; limit and offset select a page of them.'''
+
+    (kind, abbrev), rest = tags[0], tags[1:]
+
+    # first tag drives an index scan; the rest are filters.
+    where = '''abbrev_id = (SELECT abbrev_id FROM abbreviations WHERE abbrev = ?)
+      AND kind = ?'''
+    params = [abbrev, kind]
+    if rest:
+        rest_sql, rest_params = tags_where(rest)
+        where += ' AND ' + rest_sql
+        params += rest_params
+    if frequent:
+        where += ' AND ent_seq IN (SELECT ent_seq FROM entries WHERE frequent = 1)'
+
+    page_sql, page_params = limit_sql(limit, offset)
+
+    database.execute(cur, '''
+SELECT ent_seq
+FROM sense_tags
+WHERE %s
+GROUP BY ent_seq
+ORDER BY (SELECT freq_rank FROM entries WHERE entries.ent_seq = sense_tags.ent_seq),
+         ent_seq
+%s
+;''' % (where, page_sql), params + page_params)
+
+    return [row[0] for row in cur.fetchall()]
+
+def to_hepburn(string):
+    '''Normalize rōmaji string (Hepburn or Kunrei) to Hepburn.
+
+    The result can be compared with the 'hepburn' column of readings.'''
+
+    return romkan.to_hepburn(romkan.to_hiragana(string.lower()))
+
+def search_whole_batch(cur, field, terms, frequent=False, tags=()):
+    '''Set-based search_by() for many whole-extent queries at once.
+
+    field is 'kanji' or 'reading'; terms are the query strings.  Return a
+    dict of term -> list of ent_seqs, most frequent first (same order as
+    search_by()).  Terms with no results are missing from the dict.'''
+
+    table = {'kanji': 'kanjis', 'reading': 'readings'}[field]
+
+    where_extra = ''
+    extra_params = []
+    if frequent:
+        where_extra += ' AND frequent = 1'
+    if tags:
+        tags_sql, extra_params = tags_where(tags)
+        where_extra += ' AND ' + tags_sql
+
+    terms = list(set(terms))
+    found = {}
+    # keep under sqlite's limit of parameters
+    chunk = 500 - len(extra_params)
+    for i in range(0, len(terms), chunk):
+        part = terms[i:i+chunk]
+        database.execute(cur, '''
+SELECT %s, ent_seq
+FROM %s
+WHERE %s IN (%s) %s
+GROUP BY %s, ent_seq
+ORDER BY min(freq_rank), ent_seq
+;'''
+                         % (field, table, field, ','.join('?' * len(part)),
+                            where_extra, field),
+                         part + extra_params)
+        for term, ent_seq in cur.fetchall():
+            found.setdefault(term, []).append(ent_seq)
+
+    return found
 
 def generate_search_conditions(args):
     '''args = command-line argument dict (argparse object)'''
@@ -93,7 +351,10 @@ def generate_search_conditions(args):
         else:
             fields = ('kanji', 'reading', 'gloss')
 
-    if args.extent != 'auto':
+    if args.extent == 'fuzzy':
+        # only the fuzzy conditions below
+        extents = ()
+    elif args.extent != 'auto':
         extents = (args.extent,)
     else:
         extents = ('whole', 'word', 'beginning', 'partial')
@@ -118,34 +379,69 @@ def generate_search_conditions(args):
                         extent = 'whole'
 
                 if field == 'reading' and tt.is_latin(args.query_s):
-                    # 'reading' field auto-convert romaji to kana. as of this
-                    # writing, JMdict has no romaji in readingfields.
-                    queries = ([romkan.to_hiragana(s) for s in args.query],
-                               [romkan.to_katakana(s) for s in args.query])
-
-                    # romkan will convert ASCII hyphen-minus to CJKV long 'ー'
-                    # we back-convert it in start position, to preserve FTS
-                    # operator '-'.
-                    def fix_hyphen(s):
-                        if len(s) > 1 and s[0] == 'ー':
-                            s = '-' + s[1:]
-                        return s
-
-                    queries = [[fix_hyphen(s) for s in query]
-                               for query in queries]
+                    # 'reading' field looks up rōmaji in the precomputed
+                    # Hepburn column.  as of this writing, JMdict has no
+                    # romaji in reading fields.
+                    if regexp:
+                        query = [s.lower() for s in args.query]
+                    else:
+                        query = [to_hepburn(s) for s in args.query]
+                    conditions.append(SearchConditions(args, query, regexp,
+                                                       field, extent,
+                                                       romaji=True))
                 else:
-                    queries = (args.query,)
-                # TODO: add wide-char
-
-                for query in queries:
-                    conditions.append(SearchConditions(args, query, regexp, field, extent))
+                    # TODO: add wide-char
+                    conditions.append(SearchConditions(args, args.query,
+                                                       regexp, field, extent))
+
+    # conjugated verbs and adjectives (see deinflect.py)
+    if (args.extent == 'auto' and not args.regexp
+        and args.field in ('auto', 'kanji', 'reading')
+        and not tt.is_latin(args.query_s)
+        and deinflect.candidates(args.query_s)):
+
+        if args.field != 'auto':
+            field = args.field
+        elif tt.is_kana(args.query_s):
+            field = 'reading'
+        else:
+            field = 'kanji'
+        conditions.append(SearchConditions(args, args.query, False,
+                                           field, 'inflected'))
+
+    # typo-tolerant (see fuzzy.py)
+    if args.extent in ('auto', 'fuzzy') and not args.regexp:
+        if args.field != 'auto':
+            fields = (args.field,)
+        elif tt.is_latin(args.query_s):
+            fields = ('gloss', 'reading')
+        elif tt.is_kana(args.query_s):
+            fields = ('reading',)
+        else:
+            fields = ('kanji',)
+        for field in fields:
+            conditions.append(SearchConditions(args, args.query, False,
+                                               field, 'fuzzy'))
 
     return conditions
 
 def search_by(cur, cond):
     '''Main search function.  Take a SearchCondition object, return list of ent_seqs.
+
+    Results are ranked, best first, by:
+     - frequency (entries.freq_rank);
+     - match quality, for FTS searches (database.match_score());
+     - length of the matched field (shorter is closer to the query).
+
+    Ranking, cond.limit and cond.offset are applied in SQL, so that only the
+    requested page of results is returned.
     '''
 
+    if cond.extent == 'inflected':
+        return deinflect.search_inflected(cur, cond)
+    elif cond.extent == 'fuzzy':
+        return fuzzy.search_fuzzy(cur, cond)
+
     if ((cond.field == 'gloss' and cond.case_sensitive)
         or cond.extent in ('whole', 'partial')):
         fts=False
@@ -197,6 +493,7 @@ def search_by(cur, cond):
             table = 'glosses'
 
     where_extra = ''
+    extra_params = []
 
     if cond.regexp or (not fts and cond.extent == 'word'):
         # case sensitivity set for operator in opendb()
@@ -207,6 +504,18 @@ def search_by(cur, cond):
         elif cond.extent == 'beginning':
             query_s = '^' + query_s
         elif cond.extent == 'word':
+            if not cond.regexp:
+                query_s = re.escape(query_s)
+
+                if cond.field == 'gloss':
+                    # every word in the query must be a whole word in the
+                    # gloss, so we only run the regexp on glosses having all
+                    # of them (looked up in the index).
+                    words_sql, extra_params = gloss_words_where(
+                        tt.words(cond.query_s))
+                    if words_sql:
+                        where_extra += ' AND ' + words_sql
+
             query_s = r'\b' + query_s + r'\b'
 
     else:
@@ -219,34 +528,57 @@ def search_by(cur, cond):
                 operator = '= ?'
                 query_s = query_s.replace('\\', '\\\\')
                 if cond.case_sensitive and cond.field == 'gloss':
-                    where_extra = 'COLLATE BINARY';
+                    where_extra = 'COLLATE BINARY' + where_extra
 
             else:
                 # extent = 'partial
 
-                # "\" seems to be the least common character in EDICT.
-                operator = r"LIKE ? ESCAPE '\'"
-
-                # my editor doesn't like raw strings
-                # query_s = query_s.replace(r'\', r'\\')
-                query_s = query_s.replace('\\', '\\\\')
-
-                query_s = query_s.replace('%', r'\%')
-                query_s = query_s.replace('_', r'\_')
+                operator = like_operator
+                query_s = '%' + like_escape(query_s) + '%'
 
-                query_s = '%' + query_s + '%'
+                if cond.field == 'kanji':
+                    # only run LIKE on kebs having all characters of the
+                    # query.
+                    chars_sql, extra_params = kanji_chars_where(cond.query_s)
+                    if chars_sql:
+                        where_extra += ' AND ' + chars_sql
 
     if cond.frequent:
         where_extra += ' AND %s.frequent = 1' % table
 
+    params = [query_s] + extra_params
+    if cond.tags:
+        tags_sql, tags_params = tags_where(cond.tags)
+        where_extra += ' AND ' + tags_sql
+        params += tags_params
+
+    # matchinfo() can't be used inside aggregates, so the per-row ranking
+    # values are computed in a subquery.  'LIMIT -1' keeps sqlite from
+    # flattening it back into the aggregate.
+    if operator == 'MATCH ?':
+        score = 'match_score(matchinfo(%s))' % table
+    else:
+        score = '0'
+
+    page_sql, page_params = limit_sql(cond.limit, cond.offset)
+    params += page_params
 
     database.execute(cur, '''
-SELECT DISTINCT ent_seq
-FROM %s
-WHERE %s %s %s
+SELECT ent_seq
+FROM (
+  SELECT ent_seq, freq_rank, %s AS score, length(%s) AS len
+  FROM %s
+  WHERE %s %s %s
+  LIMIT -1
+)
+GROUP BY ent_seq
+ORDER BY min(freq_rank), max(score) DESC, min(len), ent_seq
+%s
 ;'''
-                % (table, cond.field, operator, where_extra),
-                [query_s])
+                % (score, cond.column(),
+                   table, cond.column(), operator, where_extra,
+                   page_sql),
+                params)
 
     res = []
     for row in cur.fetchall():
@@ -262,6 +594,13 @@ def guess(cur, conditions):
     guess() will try all in sort order, and choose the first one with
     >0 results.
 
+    Conditions that provably can't match are skipped (see planner.py).
+
+    Each search is limited by the timeout and max_steps of its condition.
+    If it goes over them, database.QueryTimeout is raised; or, if the
+    condition has skip_timeouts, the error message is saved in its
+    timed_out attribute, and guess() goes on to the next one.
+
     Return value: 2-tuple (condition, entries) where:
      - condition is the chosen SearchConditions object
      - entries is a list of entries (see search_by() )
@@ -271,24 +610,72 @@ def guess(cur, conditions):
     if common.debug:
         import pprint; pprint.pprint(conditions)
     for condition in conditions:
-        res = search_by(cur, condition)
-        if len(res) > 0:
+        if not planner.possible(cur, condition):
+            continue
+        try:
+            res = database.run_with_budget(cur, condition.budget(),
+                                           try_condition, condition)
+        except database.QueryTimeout as e:
+            if not condition.skip_timeouts:
+                raise
+            condition.timed_out = str(e)
+            continue
+        if res is not None:
             return (condition, res)
     return (None, [])
 
-def matched_regexp(conds):
+def try_condition(cur, condition):
+    '''One step of guess().
+
+    Return the list of ent_seqs found by search_by(), or None if guess()
+    should go on to the next condition.'''
+
+    res = search_by(cur, condition)
+    if len(res) > 0:
+        return res
+    elif condition.offset:
+        # maybe there are results, just not in the requested page; if
+        # so this is still the condition to choose.
+        probe = copy(condition)
+        probe.limit = 1
+        probe.offset = 0
+        if search_by(cur, probe):
+            return res
+    return None
+
+def matched_regexp(conds, romaji_output=False):
     '''Return a regexp that reflects what the SearchConditions matched.
 
     Used to color the result, with the params returned by guess().
+
+    romaji_output should be True if readings will be printed in rōmaji.
     '''
 
     # TODO: there's some duplication between this logic and search_by()
     # TODO: support word search
 
     reg = conds.query_s
-    if not conds.regexp:
+    if conds.extent == 'inflected':
+        # color the dictionary forms that were found
+        forms = deinflect.candidates(conds.query_s)
+        reg = '(?:%s)' % '|'.join(re.escape(form) for form in forms)
+    elif conds.extent == 'fuzzy':
+        # color the similar terms that were found
+        terms = getattr(conds, 'matched_terms', None) or [conds.query_s]
+        if conds.field == 'reading' and not romaji_output:
+            terms = [romkan.to_hiragana(t) for t in terms] + \
+                    [romkan.to_katakana(t) for t in terms]
+        reg = '(?:%s)' % '|'.join(re.escape(t) for t in terms)
+        if conds.field == 'gloss':
+            reg = r'\b' + reg + r'\b'
+    elif not conds.regexp:
         reg = re.escape(reg)
 
+        if conds.romaji and not romaji_output:
+            # rōmaji query, kana output; match either kana equivalent.
+            reg = '(?:%s|%s)' % (re.escape(romkan.to_hiragana(conds.query_s)),
+                                 re.escape(romkan.to_katakana(conds.query_s)))
+
     if conds.extent == 'whole':
         reg = '^' + reg + '$'
     elif conds.extent == 'beginning':
@@ -44,22 +44,25 @@ def get_regexp(pattern, flags):
 
     We use this helper function so that the SQL hooks don't have to
     compile the same regexp at every query.
-
-    Warning: Flags are not part of the hash. In other words, this function
-    doesn't work for the same pattern with different flags.
     '''
 
-    if pattern in regexp_store.keys():
-        return regexp_store[pattern]
+    key = (pattern, flags)
+    if key in regexp_store:
+        return regexp_store[key]
     else:
         try:
             comp = re.compile(pattern, re.U | flags)
-            regexp_store[pattern] = comp
+            regexp_store[key] = comp
             return comp
         except re.error:
-            regexp_store[pattern] = matchesnothing
+            regexp_store[key] = matchesnothing
             return matchesnothing
 
+word_regexp = re.compile(r'\w+')
+def words(string):
+    '''Return list of words in string, as delimited by regexp \\b.'''
+    return word_regexp.findall(string)
+
 def has_regexp_special(string):
     '''True if string has special characters of regular expressions.'''
     special = re.compile('[%s]' % re.escape(r'.^$*+?{}()[]\|'))
@@ -36,7 +36,7 @@ setup(name='myougiden',
       author_email='leoboiko@gmail.com',
       url='https://github.com/leoboiko/myougiden',
       packages=['myougiden'],
-      scripts=['bin/myougiden', 'bin/updatedb-myougiden'],
+      scripts=['bin/myougiden', 'bin/updatedb-myougiden', 'bin/myougiden-serve'],
       data_files=[('etc/myougiden/', ['etc/myougiden/config.ini'])],
       license='GPLv3',
       install_requires=[
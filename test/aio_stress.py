@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Latency of cheap lookups in myougiden.aio.AsyncDictionary, alone and while
+# slow table scans run at the same time.  Uses the installed database.
+#
+# usage: aio_stress.py [lookups] [concurrent scans]
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from myougiden.aio import AsyncDictionary
+
+lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+scans = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+
+# whole-reading lookups, answered from an index
+cheap_queries = ['ちゃ', 'ねこ', 'いぬ', 'みず', 'やま', 'かわ', 'ひと', 'き']
+
+# gloss regexps, which scan the whole glosses table
+scan_query = '.*[aeiou]{3}.*[xyz]$'
+
+def percentile(times, p):
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * p / 100))]
+
+async def cheap(d, times):
+    for i in range(lookups):
+        start = time.perf_counter()
+        await d.lookup(cheap_queries[i % len(cheap_queries)],
+                       field='reading', extent='whole')
+        times.append(time.perf_counter() - start)
+
+async def scan(d, stop):
+    while not stop.is_set():
+        await d.lookup(scan_query, field='gloss', regexp=True)
+
+def report(name, times):
+    print('%-20s p50 %6.2fms  p99 %6.2fms  max %6.2fms'
+          % (name,
+             percentile(times, 50) * 1000,
+             percentile(times, 99) * 1000,
+             max(times) * 1000))
+
+async def main():
+    d = AsyncDictionary(max_workers=4, max_scans=1)
+
+    # warm up connections and caches
+    await cheap(d, [])
+
+    alone = []
+    await cheap(d, alone)
+    report('alone', alone)
+
+    stop = asyncio.Event()
+    scanners = [asyncio.ensure_future(scan(d, stop)) for i in range(scans)]
+    loaded = []
+    await cheap(d, loaded)
+    report('with %d scans' % scans, loaded)
+    stop.set()
+    await asyncio.gather(*scanners)
+
+    d.close()
+
+asyncio.run(main())
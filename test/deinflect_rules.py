@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# Checks of myougiden.deinflect.candidates() on irregular forms.  Needs no
+# database.
+#
+# usage: deinflect_rules.py
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from myougiden.deinflect import candidates
+
+def check(word, base, tag):
+    found = candidates(word)
+    assert base in found, '%s: no %s in %s' % (word, base, found)
+    assert tag in found[base], '%s: %s is %s, not %s' % (word, base,
+                                                         found[base], tag)
+
+# the potential of する is できる
+check('勉強できる', '勉強する', 'vs-i')
+check('勉強できなかった', '勉強する', 'vs-i')
+check('勉強できる', '勉強', 'vs')
+
+# not しられる
+found = candidates('勉強しられる')
+assert '勉強する' not in found, found
+
+print('ok')
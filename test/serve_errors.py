@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# Queries myougiden-serve can't run must get an error response, and leave
+# the connection (and the rest of a /batch) working.  Starts the server on
+# a spare port; uses the installed database.
+#
+# usage: serve_errors.py
+
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+root = os.path.join(os.path.dirname(__file__), '..')
+
+# FTS can't parse the unbalanced quote
+malformed = 'tea"'
+
+def spare_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_server(port):
+    env = dict(os.environ, PYTHONPATH=root)
+    server = subprocess.Popen([sys.executable,
+                               os.path.join(root, 'bin', 'myougiden-serve'),
+                               '-p', str(port)],
+                              env=env, stdout=subprocess.DEVNULL)
+    for i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    sys.exit('server did not start')
+
+def main():
+    port = spare_port()
+    server = start_server(port)
+    try:
+        con = http.client.HTTPConnection('127.0.0.1', port)
+
+        con.request('GET', '/lookup?q=tea%22&extent=word&field=gloss')
+        res = con.getresponse()
+        body = json.loads(res.read())
+        assert res.status == 400, res.status
+        assert 'error' in body, body
+
+        # same (keep-alive) connection
+        con.request('GET', '/lookup?q=tea&extent=word&field=gloss')
+        res = con.getresponse()
+        res.read()
+        assert res.status == 200, res.status
+
+        queries = ['tea', malformed, 'ceremony']
+        con.request('POST', '/batch',
+                    json.dumps({'queries': queries,
+                                'options': {'extent': 'word',
+                                            'field': 'gloss'}}))
+        res = con.getresponse()
+        lines = [json.loads(line) for line in res.read().splitlines()]
+        assert res.status == 200, res.status
+        assert [line['query'] for line in lines] == queries, lines
+        assert 'entries' in lines[0] and 'entries' in lines[2], lines
+        assert 'error' in lines[1], lines[1]
+    finally:
+        server.terminate()
+        server.wait()
+
+    print('ok')
+
+main()